@@ -3,43 +3,123 @@
 Created on Sun May 17 22:19:49 2020
 @author: Mike McGurrin
 Updated to improve speed and run on Pi Zero 7/13/2020
+Updated to defer PyAudio, scipy and hardware setup until they are needed
 """
 import wave
 import time
-import pyaudio
+import heapq
 import atexit
+import itertools
+import threading
+from collections import deque
 import numpy as np
-from bandpassFilter import BPFilter
 import config as c
 import control
+import startup
 from platforms import hardware
 
+pyaudio = None      # imported on first use of AUDIO.p
+
 try:
     import custom_servo_handler as csh
 except ImportError:
     csh = None
 
 c.update()
-hardware.setup()
+
+class PreparedTrack:
+    """A WAV file opened ahead of time, with its first seconds of PCM in memory
+    and, once computed, its jaw track. Reads like a wave reader, serving frames
+    from memory before the file."""
+    def __init__(self, filename, head_seconds=2.0):
+        self.filename = filename
+        self.wf = wave.open(filename, 'rb')
+        self.channels = self.wf.getnchannels()
+        self.sampwidth = self.wf.getsampwidth()
+        self.rate = self.wf.getframerate()
+        self.frame_size = self.channels * self.sampwidth
+        self.head = self.wf.readframes(int(self.rate * head_seconds))
+        self.head_pos = 0
+        self.jaw_track = None
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sampwidth
+
+    def getframerate(self):
+        return self.rate
+
+    def readframes(self, n):
+        if self.head_pos >= len(self.head):
+            return self.wf.readframes(n)
+        want = n * self.frame_size
+        data = self.head[self.head_pos:self.head_pos + want]
+        self.head_pos += len(data)
+        if len(data) < want:
+            data += self.wf.readframes((want - len(data)) // self.frame_size)
+        return data
+
+    def close(self):
+        self.wf.close()
+
+class CueScheduler:
+    """Runs actions at given time.monotonic() times on a worker thread, so an
+    audio callback only has to queue them"""
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def at(self, due, action, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._seq), action, args))
+            self._cond.notify()
+
+    def close(self):
+        """Waits for the queued actions to run, then stops the thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = None
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                    elif self._closed:
+                        return
+                    self._cond.wait(wait)
+                due, _, action, args = heapq.heappop(self._heap)
+            action(*args)
 
 class AUDIO:
     def __init__(self):
-        print("Initializing PyAudio...")
-        self.p = pyaudio.PyAudio()
-        print("if you see ALSA error messages above, ignore them")
-        print("End of PyAudio initialization")
+        with startup.step("hardware.setup()"):
+            hardware.setup()
+        self._p = None
+        self._bp = None
         
         # Create servo using platform hardware abstraction
-        self.jaw = hardware.create_servo(
-            c.JAW_PIN, 
-            min_angle=c.MIN_ANGLE, 
-            max_angle=c.MAX_ANGLE, 
-            min_pulse_width=c.SERVO_MIN/(1*10**6),
-            max_pulse_width=c.SERVO_MAX/(1*10**6)
-        )
+        with startup.step("create jaw servo"):
+            self.jaw = hardware.create_servo(
+                c.JAW_PIN, 
+                min_angle=c.MIN_ANGLE, 
+                max_angle=c.MAX_ANGLE, 
+                min_pulse_width=c.SERVO_MIN/(1*10**6),
+                max_pulse_width=c.SERVO_MAX/(1*10**6)
+            )
         if csh is not None:  self.jaw.set_angle_handler(csh.handler)
         
-        self.bp = BPFilter()
         # flipping MIN_ANGLE and MAX_ANGLE in settings changes direction of servo movement BUT
         # must use unflipped values in calculating the amount of jaw movement
         if c.MIN_ANGLE > c.MAX_ANGLE:
@@ -48,6 +128,70 @@ class AUDIO:
         else:
             self.j_min = c.MAX_ANGLE
             self.j_max = c.MIN_ANGLE          
+        self.stop_requested = False
+        self.cfg = c.current    # config snapshot; swapped only between tracks
+        self.overrides = {}     # the playing track's own settings (profile, STYLE)
+        self.eyes = None        # optional eyes.PWMEyes, driven from get_target's volume
+        self.volume = 0
+        self.latencies = deque(maxlen=100)   # trigger-to-sound, seconds
+        self.last_latency = None    # of the track playing or last played; None if it had none
+        # angles the servo was created for; live changes are kept inside them
+        self.servo_range = sorted((c.MIN_ANGLE, c.MAX_ANGLE))
+        
+    @property
+    def p(self):
+        """PyAudio instance, created (and pyaudio imported) when audio first starts"""
+        global pyaudio
+        if self._p is None:
+            with startup.step("import pyaudio"):
+                import pyaudio
+            print("Initializing PyAudio...")
+            with startup.step("PyAudio()"):
+                self._p = pyaudio.PyAudio()
+            print("if you see ALSA error messages above, ignore them")
+            print("End of PyAudio initialization")
+        return self._p
+
+    @property
+    def bp(self):
+        """Bandpass filter, only needed (and scipy only imported) for STYLE=2"""
+        if self._bp is None:
+            from bandpassFilter import BPFilter
+            self._bp = BPFilter()
+        return self._bp
+
+    def apply_config(self, snapshot, pushed=()):
+        """Switches to a new config snapshot while playing (live tuning from the
+        control panel). The playing track's own settings stay on top of it,
+        except the pushed ones, which win for the rest of the track.
+        The callback picks it up at the next chunk."""
+        self.overrides = {k: v for k, v in self.overrides.items() if k not in pushed}
+        if self.overrides:
+            snapshot = snapshot.replace(self.overrides)
+        low, high = self.servo_range
+        min_angle = min(max(snapshot.MIN_ANGLE, low), high)
+        max_angle = min(max(snapshot.MAX_ANGLE, low), high)
+        if (min_angle, max_angle) != (snapshot.MIN_ANGLE, snapshot.MAX_ANGLE):
+            print(f"Jaw angles limited to {low}-{high} until ChatterPi is restarted")
+        if min_angle > max_angle:
+            self.j_min, self.j_max = min_angle, max_angle
+        else:
+            self.j_min, self.j_max = max_angle, min_angle
+        if snapshot.STYLE == 2:
+            self.bp     # build the filter before the callback needs it
+        self.cfg = snapshot
+        if self.eyes is not None:
+            self.eyes.set_levels(*self.eye_levels())
+
+    def stop(self):
+        """Ask the track that is currently playing to end early (e.g. preempted)"""
+        self.stop_requested = True
+
+    def clear_stop(self):
+        """Forgets a stop request. Called as the arbiter hands out the next
+        trigger, not when playback starts, so a preemption that arrives while
+        the track is still being opened isn't lost."""
+        self.stop_requested = False
         
     def update_jaw(self):
         # Create servo using platform hardware abstraction
@@ -67,51 +211,84 @@ class AUDIO:
             self.j_min = c.MAX_ANGLE
             self.j_max = self.MIN_ANGLE    
            
-    def play_vocal_track(self, filename=None):
-        # Used for both threshold (Scary Terry style) and multi-level (jawduino style)
-        def get_avg(levels, channels):
-            """Gets and returns the average volume for the frame (chunk).
-            for stereo channels, only looks at the right channel (channel 1)"""
-            # Apply bandpass filter if STYLE=2
-            if c.STYLE == 2:
-                levels = self.bp.filter_data(levels)
-            levels = np.absolute(levels)
-            if channels == 1:
-                avg_volume = np.sum(levels)//len(levels)
-            elif channels == 2:
-                rightLevels = levels[1::2]
-                avg_volume = np.sum(rightLevels)//len(rightLevels)
-            return(avg_volume)
-         
-        def get_target(data, channels):
-            levels = abs(np.frombuffer(data, dtype='<i2'))
-            volume = get_avg(levels, channels)
-            jawStep = (self.j_max - self.j_min) / 3
-            if c.STYLE == 0:      # Scary Terry style single threshold
-                if volume > c.THRESHOLD: 
-                    jawTarget = self.j_max
-                else: 
-                    jawTarget = self.j_min
-            elif c.STYLE == 1:     # Jawduino style multi-level or Wee Talker bandpss multi-level   
-                if volume > c.LEVEL3:
-                    jawTarget = self.j_max
-                elif volume > c.LEVEL2:
-                    jawTarget = self.j_min + 2 * jawStep
-                elif volume > c.LEVEL1:
-                    jawTarget = self.j_min + jawStep
-                else:
-                    jawTarget = self.j_min
-            else:     # Jawduino style multi-level or Wee Talker bandpss multi-level   
-                if volume > c.FILTERED_LEVEL3:
-                    jawTarget = self.j_max
-                elif volume > c.FILTERED_LEVEL2:
-                    jawTarget = self.j_min + 2 * jawStep
-                elif volume > c.FILTERED_LEVEL1:
-                    jawTarget = self.j_min + jawStep
-                else:
-                    jawTarget = self.j_min   
-            return jawTarget      
-        
+    def latency_report(self):
+        """Summarizes recent trigger-to-sound latencies"""
+        if not self.latencies:
+            return "no triggered vocals played"
+        ms = sorted(l * 1000 for l in self.latencies)
+        return (f"{len(ms)} vocals, avg {sum(ms)/len(ms):.0f} ms, "
+                f"median {ms[len(ms)//2]:.0f} ms, max {ms[-1]:.0f} ms")
+
+    # Used for both threshold (Scary Terry style) and multi-level (jawduino style)
+    def get_avg(self, levels, channels, cfg=None):
+        """Gets and returns the average volume for the frame (chunk).
+        for stereo channels, only looks at the right channel (channel 1).
+        cfg is the snapshot the callback read for this chunk (self.cfg if None)."""
+        # Apply bandpass filter if STYLE=2
+        if (cfg or self.cfg).STYLE == 2:
+            levels = self.bp.filter_data(levels)
+        levels = np.absolute(levels)
+        if channels == 1:
+            avg_volume = np.sum(levels)//len(levels)
+        elif channels == 2:
+            rightLevels = levels[1::2]
+            avg_volume = np.sum(rightLevels)//len(rightLevels)
+        return(avg_volume)
+     
+    def eye_levels(self):
+        """Chunk volumes that map to dim and full PWM eye brightness for the current STYLE"""
+        cfg = self.cfg
+        if cfg.STYLE == 0:
+            return 0, cfg.THRESHOLD
+        elif cfg.STYLE == 1:
+            return cfg.LEVEL1, cfg.LEVEL3
+        return cfg.FILTERED_LEVEL1, cfg.FILTERED_LEVEL3
+
+    def get_target(self, data, channels, cfg=None):
+        cfg = cfg or self.cfg
+        levels = abs(np.frombuffer(data, dtype='<i2'))
+        return self.target_for_volume(self.get_avg(levels, channels, cfg), cfg)
+
+    def target_for_volume(self, volume, cfg=None):
+        """Maps a chunk volume (from get_avg or a precomputed jaw track) to a jaw angle"""
+        self.volume = volume
+        cfg = cfg or self.cfg
+        jawStep = (self.j_max - self.j_min) / 3
+        if cfg.STYLE == 0:      # Scary Terry style single threshold
+            if volume > cfg.THRESHOLD: 
+                jawTarget = self.j_max
+            else: 
+                jawTarget = self.j_min
+        elif cfg.STYLE == 1:     # Jawduino style multi-level or Wee Talker bandpss multi-level   
+            if volume > cfg.LEVEL3:
+                jawTarget = self.j_max
+            elif volume > cfg.LEVEL2:
+                jawTarget = self.j_min + 2 * jawStep
+            elif volume > cfg.LEVEL1:
+                jawTarget = self.j_min + jawStep
+            else:
+                jawTarget = self.j_min
+        else:     # Jawduino style multi-level or Wee Talker bandpss multi-level   
+            if volume > cfg.FILTERED_LEVEL3:
+                jawTarget = self.j_max
+            elif volume > cfg.FILTERED_LEVEL2:
+                jawTarget = self.j_min + 2 * jawStep
+            elif volume > cfg.FILTERED_LEVEL1:
+                jawTarget = self.j_min + jawStep
+            else:
+                jawTarget = self.j_min   
+        return jawTarget
+
+    def play_vocal_track(self, filename=None, trigger_time=None, jaw_track=None, style=None,
+                         profile=None):
+        """filename may be a path, a PreparedTrack, a wavstream.GrowingWavReader
+        or an audioserver.Clip; a reader is played even when SOURCE is
+        MICROPHONE. style overrides STYLE for this track. If trigger_time (a
+        time.monotonic() stamp) is given, the delay until the first audio
+        callback is recorded in self.latencies. A jawtrack.JawTrack for the
+        file replaces the per-chunk volume analysis when it matches the
+        chunk size and STYLE. A trackindex profile overrides [CONTROLLER]
+        settings for this track and may set GAIN, a playback gain in dB."""
         def overwrite(data, channels):
             """ overwrites left channel onto right channel for playback"""
             if channels != 2:
@@ -125,17 +302,33 @@ class AUDIO:
             return new_levels
         
         def filesCallback(in_data, frame_count, time_info, status):
-            nonlocal latest_time
+            nonlocal latest_time, first_callback, block_index
+            if first_callback:
+                first_callback = False
+                if trigger_time is not None:
+                    self.last_latency = time.monotonic() - trigger_time
+                    self.latencies.append(self.last_latency)
             data = wf.readframes(frame_count)
             channels = wf.getnchannels()
             # Only proces jaw movements 50x per second, to avoid buffer overruns
             now = time.monotonic()
+            cfg = self.cfg      # one snapshot per chunk, even if a live push swaps it
             if now - latest_time > 0.02:
                 latest_time = now   
-                jawTarget = get_target(data, channels)
+                if (jaw_track is not None and block_index < len(jaw_track.volumes)
+                        and jaw_track.matches(frame_count, cfg.STYLE)):
+                    jawTarget = self.target_for_volume(jaw_track.volumes[block_index], cfg)
+                else:
+                    jawTarget = self.get_target(data, channels, cfg)
                 self.jaw.angle = jawTarget
+                if self.eyes is not None:
+                    self.eyes.set_volume(self.volume)
+            block_index += 1
+            if gain != 1 and file_sw == 2:
+                levels = np.frombuffer(data, dtype='<i2') * gain
+                data = np.clip(levels, -32768, 32767).astype('<i2').tobytes()
             # If only want left channel of input, duplicate left channel on right
-            if (channels == 2) and (c.OUTPUT_CHANNELS == 'LEFT'):
+            if (channels == 2) and (cfg.OUTPUT_CHANNELS == 'LEFT'):
                 data = overwrite(data, channels)
             return (data, pyaudio.paContinue)  
            
@@ -146,28 +339,53 @@ class AUDIO:
             now = time.monotonic()
             if now - latest_time > 0.02:
                 latest_time = now   
-                jawTarget = get_target(in_data, channels)
+                jawTarget = self.get_target(in_data, channels, self.cfg)
                 self.jaw.angle = jawTarget            
+                if self.eyes is not None:
+                    self.eyes.set_volume(self.volume)
             return (in_data, pyaudio.paContinue)     
                
         def normalEnd():
             self.stream.stop_stream()
             self.stream.close()
-            if (c.SOURCE == 'FILES'):
+            if from_file:
                 wf.close()
             self.jaw.angle = None  
+            if self.eyes is not None:
+                self.eyes.stop()
             
         def cleanup():
             normalEnd()
-            self.p.terminate()
+            if self._p is not None:
+                self._p.terminate()
             self.jaw.close()
             
+        from_file = c.SOURCE == 'FILES' or filename is not None
         try:
             atexit.register(cleanup)                      
+            self.last_latency = None
+            self.cfg = cfg = c.current
+            changes = dict(profile or {})
+            gain = 10 ** (changes.pop('GAIN', 0.0) / 20)
+            if style is not None:
+                changes['STYLE'] = style
+            self.overrides = changes
+            if changes:
+                self.cfg = cfg = cfg.replace(changes)
+            if cfg.STYLE == 2:
+                self.bp     # build the filter before the callback needs it
+            if self.eyes is not None:
+                self.eyes.set_levels(*self.eye_levels())
+                self.eyes.start()
             #Playing from wave file
-            if c.SOURCE == 'FILES':
-                wf = wave.open(filename, 'rb')
+            if from_file:
+                if isinstance(filename, str):
+                    wf = wave.open(filename, 'rb')
+                else:
+                    wf = filename
                 file_sw = wf.getsampwidth()  
+                first_callback = True
+                block_index = 0
                 # New code to support only process jaw movements 50x per second
                 start_time = time.monotonic() 
                 latest_time = start_time                                 
@@ -177,8 +395,10 @@ class AUDIO:
                             frames_per_buffer = c.BUFFER_SIZE,
                             output=True,
                             stream_callback=filesCallback)  
-                while self.stream.is_active():                
+                while self.stream.is_active() and not self.stop_requested:
                     time.sleep(0.1)
+                if self.last_latency is not None:
+                    print(f"Trigger-to-sound latency: {self.last_latency*1000:.0f} ms")
 
             # Playing from microphone or line input
             elif c.SOURCE == 'MICROPHONE':
@@ -214,15 +434,127 @@ class AUDIO:
                             input_device_index=input_device_index,
                             stream_callback=micCallback)  
                 if c.PROP_TRIGGER != 'START':
-                    time.sleep(c.MIC_TIME)
+                    deadline = time.monotonic() + c.MIC_TIME
+                    while time.monotonic() < deadline and not self.stop_requested:
+                        time.sleep(0.1)
                     self.stream.close()   
                 else:
-                    while self.stream.is_active():
+                    while self.stream.is_active() and not self.stop_requested:
                         time.sleep(1.)                                           
             normalEnd() 
+            atexit.unregister(cleanup)   # don't pile up handlers in a long-running process
         except (KeyboardInterrupt, SystemExit):
             cleanup()               
         
+    def play_show(self, show, outputs, trigger_time=None):
+        """Plays a show.Show against the output sample clock. Vocals are mixed in
+        at their exact frame. GPIO and servo cues are handed by the callback
+        to a CueScheduler, timed for when their frame reaches the DAC
+        (output_buffer_dac_time), so they don't lead the audio by the output
+        latency. outputs maps 'eyes' and 'trigger_out' to output devices.
+        Returns a list of (cue, error_seconds): when the cue actually fired,
+        less when its frame was heard. Where the stream doesn't report DAC
+        times the output latency is taken as zero."""
+        frame_size = show.channels * show.sampwidth
+        # open every vocal up front so the callback never waits on the disk
+        prepared = {id(cue): PreparedTrack(cue.value, c.PREFETCH_SECONDS)
+                    for cue in show.cues if cue.action == 'vocal'}
+        pending = deque(show.cues)
+        active = []         # [start_frame, PreparedTrack] for vocals now playing
+        fired = []
+        position = 0
+        start = None        # time.monotonic() when the show's first frame is heard
+        latest_time = 0.0
+        scheduler = CueScheduler()
+
+        def fire(cue):
+            """Runs on the scheduler thread"""
+            if cue.action == 'servo':
+                self.jaw.angle = cue.value
+            else:
+                device = outputs.get(cue.action)
+                if device is not None:
+                    if cue.value == 'pulse':
+                        device.on()
+                        scheduler.at(time.monotonic() + 0.5, device.off)
+                    elif cue.value == 'on':
+                        device.on()
+                    else:
+                        device.off()
+            fired.append((cue, time.monotonic() - start - cue.time))
+
+        def showCallback(in_data, frame_count, time_info, status):
+            nonlocal position, start, latest_time
+            now = time.monotonic()
+            time_info = time_info or {}
+            dac = time_info.get('output_buffer_dac_time') or 0.0
+            clock = time_info.get('current_time') or 0.0
+            latency = max(dac - clock, 0.0) if dac and clock else 0.0  # until this block is heard
+            if start is None:
+                start = now + latency
+                if trigger_time is not None:
+                    self.last_latency = now - trigger_time
+                    self.latencies.append(self.last_latency)
+            block_end = position + frame_count
+            while pending and pending[0].frame < block_end:
+                cue = pending.popleft()
+                if cue.action == 'vocal':
+                    # mixed in at its exact frame below
+                    active.append([cue.frame, prepared[id(cue)]])
+                    fired.append((cue, 0.0))
+                else:
+                    offset = max(cue.frame - position, 0) / show.rate
+                    scheduler.at(now + latency + offset, fire, cue)
+
+            mix = np.zeros(frame_count * show.channels, dtype=np.int32)
+            for seg in list(active):
+                offset = max(seg[0] - position, 0)
+                data = seg[1].readframes(frame_count - offset)
+                samples = np.frombuffer(data, dtype='<i2')
+                begin = offset * show.channels
+                mix[begin:begin + len(samples)] += samples
+                if len(data) < (frame_count - offset) * frame_size:
+                    active.remove(seg)
+            block = np.clip(mix, -32768, 32767).astype('<i2').tobytes()
+            position = block_end
+
+            if active and now - latest_time > 0.02:
+                latest_time = now
+                self.jaw.angle = self.get_target(block, show.channels, self.cfg)
+                if self.eyes is not None:
+                    self.eyes.set_volume(self.volume)
+            if not pending and not active:
+                return (block, pyaudio.paComplete)
+            return (block, pyaudio.paContinue)
+
+        try:
+            self.last_latency = None
+            self.overrides = {}
+            self.cfg = c.current
+            if self.cfg.STYLE == 2:
+                self.bp     # build the filter before the callback needs it
+            if self.eyes is not None:
+                self.eyes.set_levels(*self.eye_levels())
+                self.eyes.start()
+            self.stream = self.p.open(format=self.p.get_format_from_width(show.sampwidth),
+                        channels=show.channels,
+                        rate=show.rate,
+                        frames_per_buffer=c.BUFFER_SIZE,
+                        output=True,
+                        stream_callback=showCallback)
+            while self.stream.is_active() and not self.stop_requested:
+                time.sleep(0.1)
+            self.stream.stop_stream()
+            self.stream.close()
+        finally:
+            scheduler.close()       # cues still waiting for their block to be heard
+            for track in prepared.values():
+                track.close()
+            self.jaw.angle = None
+            if self.eyes is not None:
+                self.eyes.stop()
+        return sorted(fired, key=lambda result: result[0].frame)
+
     def play_ambient_track(self, filename=None):    
         def ambientCallback(in_data, frame_count, time_info, status):
             data = wf.readframes(frame_count)
@@ -235,7 +567,8 @@ class AUDIO:
             
         def cleanup():
             normalEnd()
-            self.p.terminate()
+            if self._p is not None:
+                self._p.terminate()
             self.jaw.close()
             
         try:
@@ -253,15 +586,10 @@ class AUDIO:
             while self.stream.is_active():           
                 time.sleep(0.1)
                 # interrupt and play vocal track, moving jaw
-                if c.PROP_TRIGGER == 'PIR':
-                    if control.pir.is_pressed: 
-                        control.ambient_interrupt = True
-                        break 
-                if c.PROP_TRIGGER == 'TIMER':
-                    if time.time() > control.trigger_time: 
-                        control.ambient_interrupt = True
-                        break 
+                if control.arbiter.pending():
+                    break
             normalEnd()
+            atexit.unregister(cleanup)
                     
         except (KeyboardInterrupt, SystemExit):
             cleanup()
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Socket API for sending audio straight to the running prop
+
+Clients connect to a Unix stream socket (AUDIO_SOCKET) or, if AUDIO_TCP_PORT
+is set, to that port on localhost, and send one or more messages:
+
+    4-byte big-endian header length, JSON header, then `length` bytes of audio
+
+The header holds "length" and "format" ("wav", the default, or "pcm" with
+"rate", "channels" and "sampwidth"), plus optional "priority", "style" (a
+STYLE override for this clip) and "wait" (reply once the clip has played
+rather than once it is queued; the reply's "played" is false and "outcome"
+says why if it was dropped or cut short). Each message is answered with one
+JSON line.
+
+Clips are played in priority order through the trigger arbiter. At most
+AUDIO_BUFFER_MB of audio is held at once; beyond that the server stops
+reading, so a fast producer blocks in send() instead of growing our memory.
+
+Run this module to send a WAV file (a stand-in producer for testing):
+    python audioserver.py [-p PRIORITY] [-s STYLE] [--wait] file.wav
+"""
+
+import argparse
+import heapq
+import io
+import itertools
+import json
+import os
+import socket
+import struct
+import threading
+import wave
+
+import config as c
+import triggers
+
+HEADER = struct.Struct('>I')
+MAX_HEADER = 4096
+
+
+class Clip:
+    """In-memory PCM, read like a wave reader"""
+
+    def __init__(self, data, channels, sampwidth, rate, style=None):
+        if channels not in (1, 2):
+            raise ValueError(f"{channels} channels (only mono or stereo is supported)")
+        if sampwidth != 2:
+            raise ValueError("only 16-bit audio is supported")
+        self.data = data
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.rate = rate
+        self.style = style
+        self.frame_size = channels * sampwidth
+        self.pos = 0
+
+    @classmethod
+    def from_message(cls, header, payload):
+        """Builds a clip from a message header and its audio bytes"""
+        style = header.get('style')
+        if header.get('format', 'wav') == 'wav':
+            with wave.open(io.BytesIO(payload), 'rb') as wf:
+                return cls(wf.readframes(wf.getnframes()), wf.getnchannels(),
+                           wf.getsampwidth(), wf.getframerate(), style)
+        return cls(payload, int(header.get('channels', 1)), int(header.get('sampwidth', 2)),
+                   int(header['rate']), style)
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sampwidth
+
+    def getframerate(self):
+        return self.rate
+
+    def readframes(self, n):
+        data = self.data[self.pos:self.pos + n * self.frame_size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+def _recv_exactly(conn, n):
+    chunks = []
+    while n:
+        chunk = conn.recv(min(n, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+class AudioServer:
+    """Accepts clips over the socket API and feeds them to the arbiter"""
+
+    def __init__(self, path, tcp_port, arbiter, buffer_bytes):
+        self.path = None if path == 'NONE' else path
+        self.tcp_port = tcp_port
+        self.arbiter = arbiter
+        self.buffer_bytes = buffer_bytes
+        self.socks = []
+        self._cond = threading.Condition()
+        self._held = 0              # bytes of audio received but not yet played
+        self._clips = []            # heap of (-priority, seq, clip, size, done)
+        self._seq = itertools.count()
+        # played to the end / cut short (preempted or failed) / never started
+        self.counts = {'received': 0, 'played': 0, 'interrupted': 0, 'dropped': 0,
+                       'rejected': 0}
+
+    def start(self):
+        if self.path is not None and hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(self.path):
+                os.remove(self.path)    # left over from a previous run
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.path)
+            self._listen(sock)
+        if self.tcp_port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('127.0.0.1', self.tcp_port))
+            self._listen(sock)
+        if self.socks:
+            threading.Thread(target=self._feed, daemon=True).start()
+
+    def _listen(self, sock):
+        sock.listen()
+        self.socks.append(sock)
+        threading.Thread(target=self._accept, args=(sock,), daemon=True).start()
+
+    def _accept(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return      # socket closed
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                while self._handle(conn):
+                    pass
+            except OSError:
+                pass        # client went away
+
+    def _reply(self, conn, **reply):
+        conn.sendall(json.dumps(reply).encode() + b'\n')
+
+    def _handle(self, conn):
+        """Reads and queues one message. Returns False when the client is done."""
+        raw = _recv_exactly(conn, HEADER.size)
+        if raw is None:
+            return False
+        (header_len,) = HEADER.unpack(raw)
+        if header_len > MAX_HEADER:
+            self._reply(conn, ok=False, error="header too long")
+            return False
+        raw = _recv_exactly(conn, header_len)
+        if raw is None:
+            return False
+        try:
+            header = json.loads(raw)
+            length = int(header['length'])
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(conn, ok=False, error=f"bad header: {e}")
+            return False
+        if length > self.buffer_bytes:
+            self._reply(conn, ok=False, error=f"clip is larger than the {self.buffer_bytes} byte buffer")
+            return False
+
+        # back-pressure: don't read the clip until there is room for it
+        with self._cond:
+            while self._held + length > self.buffer_bytes:
+                self._cond.wait()
+            self._held += length
+        payload = _recv_exactly(conn, length)
+        try:
+            if payload is None:
+                raise EOFError
+            clip = Clip.from_message(header, payload)
+            if clip.style is not None:
+                c.current.replace({'STYLE': clip.style})    # validate now, not at playback
+            priority = int(header.get('priority', triggers.PRIORITIES['SOCKET']))
+        except (wave.Error, EOFError, ValueError, KeyError, TypeError) as e:
+            self._release(length)
+            with self._cond:
+                self.counts['rejected'] += 1
+            if payload is not None:
+                self._reply(conn, ok=False, error=str(e) or "truncated clip")
+            return payload is not None
+
+        done = threading.Event() if header.get('wait') else None
+        with self._cond:
+            self.counts['received'] += 1
+            heapq.heappush(self._clips, (-priority, next(self._seq), clip, length, done))
+            self._cond.notify_all()
+        if done is None:
+            self._reply(conn, ok=True, queued=True)
+        else:
+            done.wait()
+            self._reply(conn, ok=True, played=done.outcome == 'played', outcome=done.outcome)
+        return True
+
+    def _release(self, length):
+        with self._cond:
+            self._held -= length
+            self._cond.notify_all()
+
+    def _feed(self):
+        """Submits queued clips to the arbiter one at a time, best first"""
+        while True:
+            with self._cond:
+                while not self._clips:
+                    self._cond.wait()
+                neg_priority, _, clip, length, done = heapq.heappop(self._clips)
+            event = self.arbiter.submit('SOCKET', -neg_priority, clip)
+            if event is not None:
+                event.finished.wait()
+            outcome = event.outcome if event is not None else 'dropped'
+            with self._cond:
+                if outcome == 'played':
+                    self.counts['played'] += 1
+                elif outcome in ('preempted', 'failed'):
+                    self.counts['interrupted'] += 1
+                else:
+                    self.counts['dropped'] += 1
+            self._release(length)
+            if done is not None:
+                done.outcome = outcome
+                done.set()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counts)
+            stats['queued'] = len(self._clips)
+            stats['buffered_bytes'] = self._held
+        return stats
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+        self.socks = []
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def send(address, filename, priority=None, style=None, wait=False):
+    """Sends a WAV file to a running prop and returns its JSON reply. address
+    is the Unix socket path or a TCP port number."""
+    with open(filename, 'rb') as f:
+        payload = f.read()
+    header = {'format': 'wav', 'length': len(payload), 'wait': wait}
+    if priority is not None:
+        header['priority'] = priority
+    if style is not None:
+        header['style'] = style
+    raw = json.dumps(header).encode()
+    if isinstance(address, int):
+        sock = socket.create_connection(('127.0.0.1', address))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    with sock:
+        sock.sendall(HEADER.pack(len(raw)) + raw + payload)
+        return json.loads(sock.makefile().readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send a WAV file to the running prop')
+    parser.add_argument('file', help='WAV file to play')
+    parser.add_argument('-p', '--priority', type=int, default=None,
+                        help='Trigger priority (default 3, which interrupts PIR/timer vocals)')
+    parser.add_argument('-s', '--style', type=int, default=None, help='STYLE for this clip')
+    parser.add_argument('--wait', action='store_true', help='Return once the clip has played')
+    parser.add_argument('--port', type=int, default=None, help='Use the localhost TCP port')
+    args = parser.parse_args()
+    c.update()
+    address = args.port if args.port else c.AUDIO_SOCKET
+    print(send(address, args.file, args.priority, args.style, args.wait))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ Created on Fri May 15 16:44:44 2020
 
 @author: Mike McGurrin
 """
+import numpy as np
 from scipy.signal import butter, lfilter
 
 class BPFilter: 
@@ -18,8 +19,20 @@ class BPFilter:
         low = lowcut / nyq
         high = highcut / nyq
         self.b, self.a = butter(order, [low, high], btype='band')   
+        self.reset()
     
     def filter_data(self, data):
         y = lfilter(self.b, self.a, data)
         return y
 
+    def reset(self):
+        """Starts filter_chunk from rest, as for a new signal"""
+        self.zi = np.zeros(max(len(self.a), len(self.b)) - 1)
+
+    def filter_chunk(self, data):
+        """Filters the next chunk of a longer signal, carrying the filter state
+        over from the previous chunk so the result matches filter_data on the
+        whole signal"""
+        y, self.zi = lfilter(self.b, self.a, data, zi=self.zi)
+        return y
+
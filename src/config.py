@@ -4,66 +4,174 @@
 Created on Mon May 18 14:01:47 2020
 
 @author: Mike McGurrin
+Updated to load config.ini into a cached, validated snapshot that is only
+re-parsed when the file changes
 """
+import os
 from configparser import ConfigParser
-# Initialize constants from config.ini
-cfg = ConfigParser()
-def update():
-	global SERVO_MIN
-	global SERVO_MAX
-	global MIN_ANGLE
-	global MAX_ANGLE
-	global STYLE
-	global THRESHOLD
-	global LEVEL1
-	global LEVEL2
-	global LEVEL3
-	global FILTERED_LEVEL1
-	global FILTERED_LEVEL2
-	global FILTERED_LEVEL3
-	global BUFFER_SIZE
-	global SOURCE
-	global MIC_TIME
-	global OUTPUT_CHANNELS
-	global INPUT_DEVICE
-	global AMBIENT
-	global PROP_TRIGGER
-	global EYES
-	global TRIGGER_OUT
-	global DELAY
-	global JAW_PIN
-	global PIR_PIN
-	global EYES_PIN
-	global TRIGGER_OUT_PIN
-	global RPI_HW_SIMULATION
 
-	cfg.read('config.ini')
+CONFIG_FILE = 'config.ini'
+REQUIRED = object()
 
-	SERVO_MIN = int(cfg['SERVO']['SERVO_MIN'])
-	SERVO_MAX = int(cfg['SERVO']['SERVO_MAX'])
-	MIN_ANGLE = int(cfg['SERVO']['MIN_ANGLE'])
-	MAX_ANGLE = int(cfg['SERVO']['MAX_ANGLE'])
-	STYLE = int(cfg['CONTROLLER']['STYLE'])
-	THRESHOLD = int(cfg['CONTROLLER']['THRESHOLD'])
-	LEVEL1 = int(cfg['CONTROLLER']['LEVEL1'])
-	LEVEL2 = int(cfg['CONTROLLER']['LEVEL2'])
-	LEVEL3 = int(cfg['CONTROLLER']['LEVEL3'])
-	FILTERED_LEVEL1 = int(cfg['CONTROLLER']['FILTERED_LEVEL1'])
-	FILTERED_LEVEL2 = int(cfg['CONTROLLER']['FILTERED_LEVEL2'])
-	FILTERED_LEVEL3 = int(cfg['CONTROLLER']['FILTERED_LEVEL3'])
-	BUFFER_SIZE = int(cfg['AUDIO']['BUFFER_SIZE']) 
-	SOURCE = cfg['AUDIO']['SOURCE']
-	MIC_TIME = int(cfg['AUDIO']['MIC_TIME'])
-	OUTPUT_CHANNELS = cfg['AUDIO']['OUTPUT_CHANNELS']
-	INPUT_DEVICE = cfg['AUDIO'].get('INPUT_DEVICE', 'DEFAULT')
-	AMBIENT = cfg['AUDIO']['AMBIENT']
-	PROP_TRIGGER = cfg['PROP']['PROP_TRIGGER']
-	EYES = cfg['PROP']['EYES']
-	TRIGGER_OUT = cfg['PROP']['TRIGGER_OUT']
-	DELAY = int(cfg['PROP']['DELAY'])
-	JAW_PIN = int(cfg['PINS']['JAW_PIN'])
-	PIR_PIN = int(cfg['PINS']['PIR_PIN'])
-	EYES_PIN = int(cfg['PINS']['EYES_PIN'])
-	TRIGGER_OUT_PIN = int(cfg['PINS']['TRIGGER_OUT_PIN'])
-	RPI_HW_SIMULATION = bool(cfg['HARDWARE']['RPI_HW_SIMULATION'])
+# (NAME, section, type, default) for every setting; REQUIRED settings must be in config.ini
+FIELDS = (
+	('SERVO_MIN', 'SERVO', int, REQUIRED),
+	('SERVO_MAX', 'SERVO', int, REQUIRED),
+	('MIN_ANGLE', 'SERVO', int, REQUIRED),
+	('MAX_ANGLE', 'SERVO', int, REQUIRED),
+	('STYLE', 'CONTROLLER', int, REQUIRED),
+	('THRESHOLD', 'CONTROLLER', int, REQUIRED),
+	('LEVEL1', 'CONTROLLER', int, REQUIRED),
+	('LEVEL2', 'CONTROLLER', int, REQUIRED),
+	('LEVEL3', 'CONTROLLER', int, REQUIRED),
+	('FILTERED_LEVEL1', 'CONTROLLER', int, REQUIRED),
+	('FILTERED_LEVEL2', 'CONTROLLER', int, REQUIRED),
+	('FILTERED_LEVEL3', 'CONTROLLER', int, REQUIRED),
+	('BUFFER_SIZE', 'AUDIO', int, REQUIRED),
+	('SOURCE', 'AUDIO', str, REQUIRED),
+	('MIC_TIME', 'AUDIO', int, REQUIRED),
+	('OUTPUT_CHANNELS', 'AUDIO', str, REQUIRED),
+	('INPUT_DEVICE', 'AUDIO', str, 'DEFAULT'),
+	('AMBIENT', 'AUDIO', str, REQUIRED),
+	('PREFETCH_SECONDS', 'AUDIO', float, 2.0),
+	('STREAM_START_SECONDS', 'AUDIO', float, 0.5),
+	('STREAM_UNDERRUN', 'AUDIO', str, 'REBUFFER'),
+	('STREAM_IDLE_TIMEOUT', 'AUDIO', float, 2.0),
+	('NORMALIZE', 'AUDIO', str, 'PEAK'),
+	('LOUDNESS_TARGET', 'AUDIO', float, -20.0),
+	('PROP_TRIGGER', 'PROP', str, REQUIRED),
+	('EYES', 'PROP', str, REQUIRED),
+	('EYES_PWM_RATE', 'PROP', int, 30),
+	('EYES_MIN_LEVEL', 'PROP', float, 0.1),
+	('TRIGGER_OUT', 'PROP', str, REQUIRED),
+	('SHOW', 'PROP', str, 'NONE'),
+	('DELAY', 'PROP', int, REQUIRED),
+	('TRIGGER_DEBOUNCE', 'PROP', float, 1.0),
+	('TRIGGER_QUEUE', 'PROP', int, 1),
+	('PREEMPT_PRIORITY', 'PROP', int, 3),
+	('CONTROL_SOCKET', 'PROP', str, '/tmp/chatterpi.sock'),
+	('AUDIO_SOCKET', 'PROP', str, '/tmp/chatterpi-audio.sock'),
+	('AUDIO_TCP_PORT', 'PROP', int, 0),
+	('AUDIO_BUFFER_MB', 'PROP', float, 16.0),
+	('PLAYLIST', 'PROP', str, 'ORDER'),
+	('NO_REPEAT', 'PROP', int, 3),
+	('JAW_PIN', 'PINS', int, REQUIRED),
+	('PIR_PIN', 'PINS', int, REQUIRED),
+	('EYES_PIN', 'PINS', int, REQUIRED),
+	('TRIGGER_OUT_PIN', 'PINS', int, REQUIRED),
+	('RPI_HW_SIMULATION', 'HARDWARE', bool, REQUIRED),
+)
 
+# allowed values for the settings that are keywords
+CHOICES = {
+	'STYLE': (0, 1, 2),
+	'SOURCE': ('FILES', 'MICROPHONE'),
+	'AMBIENT': ('ON', 'OFF'),
+	'STREAM_UNDERRUN': ('REBUFFER', 'SILENCE'),
+	'NORMALIZE': ('PEAK', 'LOUDNESS'),
+	'PROP_TRIGGER': ('START', 'TIMER', 'PIR'),
+	'PLAYLIST': ('ORDER', 'SHUFFLE'),
+	'EYES': ('ON', 'OFF', 'PWM'),
+	'TRIGGER_OUT': ('ON', 'OFF'),
+}
+
+# smallest allowed values for numeric settings that need one
+MINIMUMS = {
+	'TRIGGER_QUEUE': 1,
+}
+
+class Config:
+	"""Read-only snapshot of config.ini. Replace it, don't modify it."""
+	__slots__ = tuple(field[0] for field in FIELDS)
+
+	def __init__(self, values):
+		for name, value in values.items():
+			object.__setattr__(self, name, value)
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Config snapshots are read-only")
+
+	def as_dict(self):
+		return {name: getattr(self, name) for name in self.__slots__}
+
+	def replace(self, changes):
+		"""Returns a validated copy with some settings changed"""
+		types = {name: kind for name, section, kind, default in FIELDS}
+		values = self.as_dict()
+		for name, raw in changes.items():
+			name = name.upper()
+			if name not in types:
+				raise ValueError(f"Unknown setting {name}")
+			try:
+				values[name] = types[name](raw)
+			except ValueError:
+				raise ValueError(f"{name} = {raw!r} is not a valid {types[name].__name__}")
+			if name in CHOICES and values[name] not in CHOICES[name]:
+				raise ValueError(f"{name} must be one of {', '.join(map(str, CHOICES[name]))}")
+			if name in MINIMUMS and values[name] < MINIMUMS[name]:
+				raise ValueError(f"{name} must be at least {MINIMUMS[name]}")
+		return Config(values)
+
+def load(path=CONFIG_FILE):
+	"""Parses and validates path into a new Config snapshot"""
+	cfg = ConfigParser()
+	cfg.read(path)
+	values = {}
+	for name, section, kind, default in FIELDS:
+		if default is REQUIRED:
+			raw = cfg[section][name]
+		else:
+			raw = cfg.get(section, name, fallback=None)
+			if raw is None:
+				values[name] = default
+				continue
+		try:
+			values[name] = kind(raw)
+		except ValueError:
+			raise ValueError(f"{path}: [{section}] {name} = {raw!r} is not a valid {kind.__name__}")
+	for name, allowed in CHOICES.items():
+		if values[name] not in allowed:
+			raise ValueError(f"{path}: {name} must be one of {', '.join(map(str, allowed))}")
+	for name, minimum in MINIMUMS.items():
+		if values[name] < minimum:
+			raise ValueError(f"{path}: {name} must be at least {minimum}")
+	return Config(values)
+
+current = None      # the active Config snapshot
+_signature = None   # (inode, mtime, size) of the file current was loaded from
+
+def update(path=CONFIG_FILE):
+	"""Reloads config.ini if it changed since the last load. The new snapshot
+	replaces `current` in one assignment and its values are also bound to
+	the module-level names (c.STYLE, c.LEVEL3, ...). Returns True on reload.
+	An invalid edit keeps the previous snapshot once one has been loaded."""
+	global current, _signature
+	try:
+		st = os.stat(path)
+		signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+	except OSError:
+		signature = None
+	if current is not None and signature == _signature:
+		return False
+	try:
+		snapshot = load(path)
+	except (KeyError, ValueError) as e:
+		if current is None:
+			raise
+		print(f"Ignoring invalid change to {path}: {e}")
+		_signature = signature
+		return False
+	current = snapshot
+	_signature = signature
+	globals().update(snapshot.as_dict())
+	return True
+
+def override(changes):
+	"""Returns a copy of the current snapshot with some settings changed (e.g.
+	pushed live from the control panel) and makes it current. config.ini is not
+	read or written; its next change on disk is loaded as usual."""
+	global current
+	snapshot = current.replace(changes)
+	current = snapshot
+	globals().update(snapshot.as_dict())
+	return snapshot
@@ -1,92 +1,156 @@
 """
 Created on Sun May 17 22:19:49 2020
 Updated to fix bad calls to audio.play_audio Sat Dec 26 2020
+Updated to route triggers through a TriggerArbiter
 @author: Mike McGurrin
 """
 
 import time
+import threading
 
 import config as c
 import tracks as t
 import audio
+import triggers
+import show
+import eyes
+import liveparams
+import audioserver
+import startup
 from platforms import hardware
 
-tracks = t.Tracks()
-a = audio.AUDIO()
+with startup.step("Tracks()"):
+    tracks = t.Tracks()
+with startup.step("AUDIO()"):
+    a = audio.AUDIO()
 
 # Use platform hardware abstraction for GPIO
 pir = hardware.create_button(c.PIR_PIN, pull_up=False)
 triggerOut = hardware.create_output(c.TRIGGER_OUT_PIN)
-eyesPin = hardware.create_output(c.EYES_PIN)
-ambient_interrupt = False   # set to True when timer goes off or PIR triggered
-trigger_time = time.time()
+if c.EYES == 'PWM':
+    # eye brightness follows the vocal, driven by AUDIO
+    eyesPin = hardware.create_pwm_output(c.EYES_PIN)
+    a.eyes = eyes.PWMEyes(eyesPin, *a.eye_levels(), rate=c.EYES_PWM_RATE,
+                          min_level=c.EYES_MIN_LEVEL)
+else:
+    eyesPin = hardware.create_output(c.EYES_PIN)
 
-def event_handler():
-    c.update()
+# All trigger sources (PIR, timer, socket) go through the arbiter.
+# With PIR triggering, DELAY is the cooldown after each show.
+arbiter = triggers.TriggerArbiter(
+    debounce={'PIR': c.TRIGGER_DEBOUNCE},
+    cooldown=c.DELAY if c.PROP_TRIGGER == 'PIR' else 0.0,
+    max_queue=c.TRIGGER_QUEUE,
+    preempt_priority=c.PREEMPT_PRIORITY)
+arbiter.on_preempt = a.stop
+arbiter.on_start = a.clear_stop
+
+# Servo/Controller changes pushed live from the control panel
+params = liveparams.ParamServer(c.CONTROL_SOCKET, a.apply_config)
+
+# Clips sent straight to the prop over the socket API
+audio_in = audioserver.AudioServer(c.AUDIO_SOCKET, c.AUDIO_TCP_PORT, arbiter,
+                                   int(c.AUDIO_BUFFER_MB * 2**20))
+
+def pir_watcher():
+    """Feeds PIR presses to the arbiter, even while a vocal is playing"""
+    while True:
+        pir.wait_for_press()
+        arbiter.submit('PIR')
+        if hasattr(pir, 'wait_for_release'):
+            pir.wait_for_release()
+
+def timer_watcher():
+    """Submits a TIMER trigger DELAY seconds after the previous one finished"""
+    while True:
+        time.sleep(c.DELAY)
+        event = arbiter.submit('TIMER')
+        if event is not None:
+            event.finished.wait()
+
+def start_watchers():
+    if c.PROP_TRIGGER == 'PIR':
+        watcher = pir_watcher
+    elif c.PROP_TRIGGER == 'TIMER':
+        watcher = timer_watcher
+    else:
+        return
+    threading.Thread(target=watcher, daemon=True).start()
+
+def event_handler(event=None):
+    c.update()   # cheap unless config.ini changed
     if c.EYES == 'ON':
         eyesPin.on()
     if c.TRIGGER_OUT == 'ON':
+        # pulse the output without holding up the vocal
         triggerOut.on()
-        time.sleep(0.5)
-        triggerOut.off()
-    if c.SOURCE == 'FILES':
-        tracks.play_vocal()
+        threading.Timer(0.5, triggerOut.off).start()
+    if event is not None and isinstance(event.payload, audioserver.Clip):
+        a.play_vocal_track(event.payload, event.timestamp, style=event.payload.style)
+    elif c.SHOW != 'NONE':
+        play_show(c.SHOW, event.timestamp if event is not None else None)
+    elif c.SOURCE == 'FILES':
+        tracks.play_vocal(event.timestamp if event is not None else None)
     else:
-        a.play_vocal_track()
+        a.play_vocal_track(trigger_time=event.timestamp if event is not None else None)
     if c.EYES == 'ON':
         eyesPin.off()
-        
+
+def play_show(show_file, trigger_time=None):
+    """Runs a show file's cue list and prints how close each cue came to its time"""
+    timeline = show.load_show(show_file)
+    fired = a.play_show(timeline, {'eyes': eyesPin, 'trigger_out': triggerOut}, trigger_time)
+    show.print_timing(timeline, fired, "Show timing")
+
+def run_next_event():
+    """Waits for the arbiter to release a trigger, then runs the show for it"""
+    event = arbiter.get()
+    outcome = 'failed'
+    try:
+        event_handler(event)
+        outcome = 'preempted' if a.stop_requested else 'played'
+    finally:
+        arbiter.done(event, outcome)
+
 def controls(fullpath_wavfile=None):
-    global trigger_time
-    global ambient_interrupt
     try:
+        # A show file given on the command line runs once
+        if fullpath_wavfile and fullpath_wavfile.endswith(show.SHOW_EXTENSIONS):
+            play_show(fullpath_wavfile)
+            return
+
         # If a specific wav file was provided, play it directly
         if fullpath_wavfile:
             tracks.play_file(fullpath_wavfile)
             return
 
-        if c.AMBIENT == 'ON':
-            if c.PROP_TRIGGER == 'START': # No ambient tracks play with this setting
-                if c.TRIGGER_OUT == 'ON':
-                    triggerOut.on()
-                if c.EYES == 'ON':
-                    eyesPin.on()
-                a.play_vocal_track()  
-            elif c.PROP_TRIGGER == 'TIMER' or c.PROP_TRIGGER == 'PIR':         
-                    while True:
-                        if c.PROP_TRIGGER == 'PIR':
-                            time.sleep(c.DELAY) 
-                        elif c.PROP_TRIGGER == 'TIMER':
-                            trigger_time = time.time() + c.DELAY
-                        tracks.play_ambient()
-                        if ambient_interrupt == True:
-                            event_handler()
-                            ambient_interrupt = False
-                            if c.PROP_TRIGGER == 'PIR':
-                                time.sleep(c.DELAY)
-        elif c.AMBIENT == 'OFF':
-            if c.PROP_TRIGGER == 'TIMER':
-                start_time = time.time()
-                while True:
-                    current_time = time.time()
-                    if current_time > start_time + c.DELAY:
-                        event_handler()
-                        start_time = time.time()
-            elif c.PROP_TRIGGER == 'PIR':
-                while True:
-                    pir.wait_for_press()
-                    event_handler()  
-                    time.sleep(c.DELAY) 
-            elif c.PROP_TRIGGER == 'START':
-                if c.TRIGGER_OUT == 'ON':
-                    triggerOut.on()
-                if c.EYES == 'ON':
-                    eyesPin.on()
-                a.play_vocal_track() 
+        params.start()
+        if c.PROP_TRIGGER == 'START': # No ambient tracks play with this setting
+            if c.TRIGGER_OUT == 'ON':
+                triggerOut.on()
+            if c.EYES == 'ON':
+                eyesPin.on()
+            a.play_vocal_track()
+        elif c.PROP_TRIGGER == 'TIMER' or c.PROP_TRIGGER == 'PIR':
+            start_watchers()
+            audio_in.start()
+            if c.SOURCE == 'FILES':
+                tracks.prefetch_vocal()
+            while True:
+                if c.AMBIENT == 'ON':
+                    # plays until the arbiter has a trigger ready
+                    tracks.play_ambient()
+                run_next_event()
 
     except Exception as e:
-        print(e)  
+        print(e)
     finally:
+        print(f"Trigger stats: {arbiter.stats()}")
+        if audio_in.socks:
+            print(f"Socket clips: {audio_in.stats()}")
+        print(f"Trigger-to-sound latency: {a.latency_report()}")
+        params.close()
+        audio_in.close()
         pir.close()
         eyesPin.close()
         triggerOut.close()
@@ -3,7 +3,9 @@ import configparser
 import sys
 import os
 import shutil
+import threading
 import maxVol
+import liveparams
 from platforms import get_platform
 
 class ConfigManager(tk.Toplevel): 
@@ -70,6 +72,10 @@ class ConfigManager(tk.Toplevel):
                 ent =  tk.Entry(frm, width=10)
                 ent.grid(row=idx, column=1, sticky='W')
                 ent.insert(0, self.parser_dict[section][section_key])
+                if section_key.upper() in liveparams.LIVE_FIELDS:
+                    # Enter tries the value on the running prop without saving
+                    ent.bind('<Return>', lambda event, key=section_key, widget=ent:
+                             self.push_live({key: widget.get()}))
                 # after deciding which to make, add to a list for convenience
                 self.fields.append(ent)
          
@@ -83,8 +89,9 @@ class ConfigManager(tk.Toplevel):
         
         # Write changes back to config file
         save_txt = tk.Label(text="""Note: only new values for the Servo and Controller parameters will take
-        effect while ChatterPi is running (at start of next vocal). ChatterPi must be 
-        restarted for changes to the other parameters to take effect.""", justify='left')
+        effect while ChatterPi is running (immediately; press Enter in a field to try a
+        value without saving). ChatterPi must be restarted for changes to the other
+        parameters to take effect.""", justify='left')
         save_txt.grid(row=3, column=1)
         save_button = tk.Button(text='SAVE', font=('bold'), bg='green', fg='white', 
                                 width=15, height=2, borderwidth=5, command=lambda: self.save_config())
@@ -99,15 +106,55 @@ class ConfigManager(tk.Toplevel):
         voice_button = tk.Button(master=vol_frm, text='Vocals', 
                                  font=('bold'), bg='deep pink', fg='white', 
                                 width=10, height=1, borderwidth=5,
-                                command=lambda: maxVol.multimax('vocals'))
+                                command=lambda: self.maximize('vocals'))
         voice_button.pack(padx=10, pady=5)
+        self.max_buttons = {'vocals': voice_button}
         
         
         # maximize volume of all audio files in ambient folder
         ambient_button = tk.Button(master=vol_frm, text='Ambient', font=('bold'), bg='hot pink', fg='white', 
                                 width=10, height=1, borderwidth=5, 
-                                command=lambda: maxVol.multimax('ambient'))
+                                command=lambda: self.maximize('ambient'))
         ambient_button.pack(padx=10, pady=5)        
+        self.max_buttons['ambient'] = ambient_button
+
+    def maximize(self, folder):
+        """Normalizes a folder's volumes (NORMALIZE = PEAK or LOUDNESS) in the
+        background, so the window stays responsive"""
+        audio = self.parser_dict.get('AUDIO', {})
+        mode = audio.get('normalize', 'PEAK').lower()
+        try:
+            target = float(audio.get('loudness_target', maxVol.LOUDNESS_TARGET))
+        except ValueError:
+            print(f"Invalid LOUDNESS_TARGET, using {maxVol.LOUDNESS_TARGET}")
+            target = maxVol.LOUDNESS_TARGET
+        button = self.max_buttons[folder]
+        if button['state'] == tk.DISABLED:
+            return      # already running on this folder
+        worker = threading.Thread(target=maxVol.multimax, args=(folder,),
+                                  kwargs={'mode': mode, 'target': target}, daemon=True)
+        button.config(state=tk.DISABLED)
+        worker.start()
+
+        # Tk isn't thread safe, so the button is re-enabled from the Tk loop
+        def check():
+            if worker.is_alive():
+                self.parent.after(500, check)
+            else:
+                button.config(state=tk.NORMAL)
+        self.parent.after(500, check)
+
+    def socket_path(self):
+        return self.parser_dict.get('PROP', {}).get('control_socket', '/tmp/chatterpi.sock')
+
+    def push_live(self, changes):
+        """Sends Servo/Controller values straight to the running ChatterPi"""
+        if liveparams.push(self.socket_path(), changes):
+            print(f"Sent to running ChatterPi: {changes}")
+
+    def write_config(self, parser):
+        with open(self.configpath, 'w') as configfile:
+            parser.write(configfile)
 
     def save_config(self):
         """Saves the contents of the form to configpath if one was passed."""
@@ -126,11 +173,17 @@ class ConfigManager(tk.Toplevel):
                     # this should maintain their order
                     new_parser_dict[section][section_key] = input
     
+        # apply changed Servo/Controller values now, then persist in the background
+        changes = {}
+        for section in self.sections:
+            for key, value in new_parser_dict[section].items():
+                if value != self.parser_dict[section].get(key):
+                    changes[key] = value
+        self.push_live(changes)
+
         parser = configparser.ConfigParser()
         parser.read_dict(new_parser_dict)
-    
-        with open(self.configpath, 'w') as configfile:
-            parser.write(configfile)
+        threading.Thread(target=self.write_config, args=(parser,)).start()
     
         # reset the form to reflect the changes
         self.build(new_parser_dict)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Audio-reactive PWM eyes for Chatter Pi
+
+The audio callback hands over the chunk volume that get_target already
+computed; a separate writer thread turns it into LED brightness at a fixed
+rate, so the callback only stores a number.
+"""
+
+import threading
+import time
+
+
+class PWMEyes:
+    """Rate-limited brightness writer for a PWM output device.
+
+    floor, ceiling -- chunk volumes mapped to minimum and full brightness
+    rate           -- maximum PWM writes per second
+    min_level      -- brightness while the vocal is silent
+    release        -- fraction of brightness kept per write when the level
+                      drops, so the eyes fade rather than snap off
+    """
+
+    def __init__(self, device, floor, ceiling, rate=30, min_level=0.1, release=0.7):
+        self.device = device
+        self.floor = floor
+        self.ceiling = max(ceiling, floor + 1)
+        self.interval = 1.0 / rate
+        self.min_level = min_level
+        self.release = release
+        self.volume = 0
+        self._brightness = 0.0
+        self._running = False
+        self._thread = None
+
+    def set_levels(self, floor, ceiling):
+        self.floor = floor
+        self.ceiling = max(ceiling, floor + 1)
+
+    def set_volume(self, volume):
+        """Called from the audio callback; just records the latest volume"""
+        self.volume = volume
+
+    def _target(self):
+        span = (self.volume - self.floor) / (self.ceiling - self.floor)
+        span = min(max(span, 0.0), 1.0)
+        return self.min_level + (1.0 - self.min_level) * span
+
+    def _run(self):
+        while self._running:
+            target = self._target()
+            if target < self._brightness:
+                target = max(target, self._brightness * self.release)
+            if abs(target - self._brightness) > 0.01:
+                self._brightness = target
+                self.device.value = target
+            time.sleep(self.interval)
+
+    def start(self):
+        if self._running:
+            return
+        self.volume = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._brightness = 0.0
+        self.device.off()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed jaw tracks for Chatter Pi
+
+A jaw track is the per-chunk volume that AUDIO.get_avg would compute while
+playing a file, worked out ahead of time for a given chunk size and STYLE.
+Volumes rather than jaw angles are stored, so threshold changes still take
+effect during playback.
+"""
+
+import wave
+import numpy as np
+
+
+class JawTrack:
+    """Per-chunk volumes of one file"""
+
+    def __init__(self, volumes, block_frames, style):
+        self.volumes = volumes
+        self.block_frames = block_frames
+        self.style = style
+
+    def matches(self, frame_count, style):
+        """True if the track was computed for this chunk size and STYLE"""
+        return frame_count == self.block_frames and style == self.style
+
+
+def moving_average(values, window):
+    """Mean of every run of `window` consecutive values (len(values) - window + 1
+    of them), from a cumulative sum in O(N). Integer input is summed exactly.
+    This is the volume envelope the analyzers plot (utils/audio_stats.py);
+    calibrate.py works on the per-chunk block_volumes instead."""
+    values = np.asarray(values)
+    if window <= 0 or len(values) < window:
+        return np.zeros(0)
+    if values.dtype.kind in 'iub':
+        values = values.astype(np.int64)
+    sums = np.cumsum(values)
+    sums = np.concatenate(([0], sums))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def block_volumes(samples, channels, block_frames, bp=None):
+    """Per-chunk volume of interleaved int16 samples, computed exactly as
+    AUDIO.get_avg does for each callback chunk: absolute values, the
+    bandpass filter (STYLE=2) run on each chunk from rest, then the mean of
+    the right channel, floored. These are means of non-overlapping chunks,
+    not a moving average, so moving_average doesn't apply; the jaw compiler
+    and calibrate.py both get their volumes from here."""
+    block_len = block_frames * channels
+    n_full = len(samples) // block_len
+    volumes = []
+    if n_full:
+        blocks = np.abs(samples[:n_full * block_len].reshape(n_full, block_len))
+        if bp is not None:
+            blocks = np.abs(bp.filter_data(blocks))
+        if channels == 2:
+            blocks = blocks[:, 1::2]
+        volumes.append(np.sum(blocks, axis=1) // blocks.shape[1])
+    tail = samples[n_full * block_len:]
+    if len(tail) >= channels:
+        levels = np.abs(tail)
+        if bp is not None:
+            levels = np.abs(bp.filter_data(levels))
+        if channels == 2:
+            levels = levels[1::2]
+        volumes.append(np.array([np.sum(levels) // len(levels)]))
+    if not volumes:
+        return np.zeros(0)
+    return np.concatenate(volumes)
+
+
+def compute_jaw_track(path, block_frames, style):
+    """Reads a 16-bit WAV file and returns its JawTrack. Runs happily in a
+    worker process."""
+    with wave.open(path, 'rb') as wf:
+        channels = wf.getnchannels()
+        if wf.getsampwidth() != 2:
+            raise ValueError(f"{path}: jaw tracks need 16-bit audio")
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2')
+    bp = None
+    if style == 2:
+        from bandpassFilter import BPFilter
+        bp = BPFilter()
+    return JawTrack(block_volumes(samples, channels, block_frames, bp), block_frames, style)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Live parameter channel for Chatter Pi
+
+The control panel sends JSON datagrams such as {"LEVEL3": 2200} to a Unix
+socket owned by the running prop. Changes apply to the running AUDIO
+instance at its next chunk; saving them to config.ini is done separately.
+"""
+
+import json
+import os
+import socket
+import threading
+
+import config as c
+
+# Servo and Controller settings that can change without a restart
+LIVE_FIELDS = ('MIN_ANGLE', 'MAX_ANGLE', 'STYLE', 'THRESHOLD',
+               'LEVEL1', 'LEVEL2', 'LEVEL3',
+               'FILTERED_LEVEL1', 'FILTERED_LEVEL2', 'FILTERED_LEVEL3')
+
+
+def push(path, changes):
+    """Sends changes to a running prop. Returns False if none is listening."""
+    changes = {k.upper(): v for k, v in changes.items() if k.upper() in LIVE_FIELDS}
+    if not changes or not hasattr(socket, 'AF_UNIX'):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(json.dumps(changes).encode(), path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class ParamServer:
+    """Receives live changes and hands the resulting config snapshot, and the
+    names of the settings that changed, to on_change"""
+
+    def __init__(self, path, on_change):
+        self.path = path
+        self.on_change = on_change
+        self.sock = None
+
+    def start(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            print("Live parameter changes are not supported on this platform")
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)    # left over from a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:
+                return      # socket closed
+            try:
+                changes = json.loads(data)
+                changes = {k.upper(): v for k, v in changes.items()}
+                ignored = [k for k in changes if k not in LIVE_FIELDS]
+                if ignored:
+                    print(f"Ignoring settings that need a restart: {', '.join(ignored)}")
+                changes = {k: v for k, v in changes.items() if k in LIVE_FIELDS}
+                if changes:
+                    self.on_change(c.override(changes), set(changes))
+                    print(f"Live settings applied: {changes}")
+            except (ValueError, AttributeError) as e:
+                print(f"Bad live settings message: {e}")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
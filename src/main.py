@@ -7,8 +7,17 @@ Created on Sun May 17 22:19:49 2020
 """
 import sys
 import os
+import startup
+
+# --profile-startup: time imports and initialization, print a report and exit
+profile_startup = '--profile-startup' in sys.argv
+if profile_startup:
+    sys.argv.remove('--profile-startup')
+    startup.enable()
+
 import config as c
-c.update()
+with startup.step("config.update()"):
+    c.update()
 
 # Check for optional wavfile argument
 fullpath_wavfile = sys.argv[1] if len(sys.argv) > 1 else None
@@ -23,5 +32,11 @@ if c.SOURCE == "FILES" and c.PROP_TRIGGER == 'START':
     raise SystemExit(1)
 
 import control
+
+if profile_startup:
+    control.a.p     # audio is otherwise started on first playback
+    startup.report()
+    sys.exit(0)
+
 # Run control loop (it will handle the wav file if provided)
 control.controls(fullpath_wavfile)
@@ -7,41 +7,311 @@ Created on Sat Aug  1 17:39:05 2020
 import wave
 import numpy as np
 import os
-from multiprocessing import Process
+import json
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from trackindex import file_hash
+
+MAXVALUE = 32767
+CHUNK_FRAMES = 65536    # frames read at a time, so memory use doesn't grow with the file
+WORKER_MEMORY = 64 * 2**20  # rough peak memory of one worker process
+MANIFEST = '.maxvol.json'   # per folder: what was normalized, and how
+
+# loudness mode
+LOUDNESS_TARGET = -20.0     # dBFS, gated RMS
+LIMITER_CEILING = -1.0      # dBFS; peaks pushed above this are limited
+LIMITER_BLOCK = 0.005       # seconds per limiter gain step
+LIMITER_HOLD = 10           # blocks each gain reduction is spread over, before and after
+MAX_GAIN_DB = 30.0          # don't boost near-silent files into noise
+
+def read_chunks(wf):
+    """Yields the samples of an open 16-bit wave file a chunk at a time"""
+    while True:
+        data = wf.readframes(CHUNK_FRAMES)
+        if not data:
+            return
+        yield np.frombuffer(data, np.int16)
+
+def find_peak(path):
+    """First pass: the largest absolute sample value in the file"""
+    peak = 0
+    with wave.open(path, 'rb') as wf:
+        for samples in read_chunks(wf):
+            peak = max(peak, int(np.max(np.abs(samples.astype(np.int32)))))
+    return peak
+
+def rewrite(path, scale):
+    """Second pass: writes scale(samples, first_frame, channels) for each chunk
+    into a temporary file that then replaces the original"""
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, wave.open(path, 'rb') as wf:
+            with wave.open(f, 'wb') as out:
+                out.setparams(wf.getparams())
+                channels = wf.getnchannels()
+                frame = 0
+                for samples in read_chunks(wf):
+                    out.writeframes(scale(samples, frame, channels).tobytes())
+                    frame += len(samples) // channels
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def apply_gain(path, gain):
+    """Scales every sample by gain, saturating at the 16-bit limits"""
+    # gain in 1/32768ths, applied in int32; |sample| * gain stays below 2**31
+    # as long as gain * peak <= 32767
+    fixed_gain = int(round(gain * 32768))
+
+    def scale(samples, frame, channels):
+        scaled = (samples.astype(np.int32) * fixed_gain) >> 15
+        np.clip(scaled, -MAXVALUE - 1, MAXVALUE, out=scaled)
+        return scaled.astype(np.int16)
+    rewrite(path, scale)
+
+class BlockReducer:
+    """Reduces a stream of per-frame values to one value per block of frames,
+    carrying partial blocks over to the next chunk"""
+    def __init__(self, block, reduce):
+        self.block = block
+        self.reduce = reduce
+        self.carry = np.zeros(0)
+        self.out = []
+
+    def add(self, values):
+        values = np.concatenate((self.carry, values))
+        n = len(values) // self.block * self.block
+        if n:
+            self.out.append(self.reduce(values[:n].reshape(-1, self.block), axis=1))
+        self.carry = values[n:]
+
+    def result(self):
+        if len(self.carry):
+            self.out.append(np.array([self.reduce(self.carry)]))
+        return np.concatenate(self.out) if self.out else np.zeros(0)
+
+def measure_loudness(path):
+    """First pass for loudness mode. Returns (loudness, block_peaks,
+    block_frames): the gated RMS level in dBFS (None if silent), and the
+    peak of each LIMITER_BLOCK of frames as a fraction of full scale.
+
+    The gating follows ITU-R BS.1770: mean square over 400 ms blocks with
+    75% overlap, an absolute gate at -70 and a relative gate 10 dB below the
+    ungated level. There is no K-weighting filter."""
+    with wave.open(path, 'rb') as wf:
+        channels = wf.getnchannels()
+        rate = wf.getframerate()
+        block_frames = max(1, int(rate * LIMITER_BLOCK))
+        energy = BlockReducer(max(1, rate // 10), np.mean)     # 100 ms steps
+        peaks = BlockReducer(block_frames, np.max)
+        for samples in read_chunks(wf):
+            frames = samples.reshape(-1, channels).astype(np.float32) / 32768
+            energy.add(np.sum(frames * frames, axis=1))
+            peaks.add(np.max(np.abs(frames), axis=1))
+    steps = energy.result()
+    if len(steps) >= 4:
+        blocks = np.convolve(steps, np.full(4, 0.25), 'valid')
+    else:
+        blocks = np.array([np.mean(steps)]) if len(steps) else np.zeros(0)
+    gated = blocks[blocks > 10 ** (-70 / 10)]
+    if not len(gated):
+        return None, peaks.result(), block_frames
+    relative = np.mean(gated) * 10 ** (-10 / 10)
+    gated = gated[gated > relative]
+    return 10 * np.log10(np.mean(gated)), peaks.result(), block_frames
+
+def limiter_gains(block_peaks, gain, ceiling=LIMITER_CEILING, hold=LIMITER_HOLD):
+    """Gain multipliers (<= 1) at each block boundary that keep block_peaks *
+    gain under the ceiling. Each boundary takes the smallest gain of the
+    `hold` blocks on either side, so interpolating between boundaries never
+    lets a block overshoot and gain changes are spread out rather than abrupt."""
+    limit = 10 ** (ceiling / 20)
+    needed = np.minimum(1.0, limit / np.maximum(block_peaks * gain, 1e-9))
+    padded = np.pad(needed, hold, constant_values=1.0)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * hold)
+    return windows.min(axis=1)      # len(block_peaks) + 1 boundaries
+
+def match_loudness(prefix, fileName, target=LOUDNESS_TARGET):
+    """Scales a 16-bit wav file to the target gated RMS loudness, limiting any
+    peaks this would push past LIMITER_CEILING. Returns the gain applied
+    (before limiting), or None if the file was skipped."""
+    if not fileName.endswith('.wav'):
+        return None
+    path = prefix+fileName
+    with wave.open(path, 'rb') as wf:
+        if wf.getsampwidth() != 2:
+            print(f"Skipping {fileName}: only 16-bit files can be normalized")
+            return None
+    loudness, block_peaks, block_frames = measure_loudness(path)
+    if loudness is None:
+        print(f"Skipping {fileName}: it is silent")
+        return None
+    gain = 10 ** (min(target - loudness, MAX_GAIN_DB) / 20)
+    boundaries = limiter_gains(block_peaks, gain) * gain
+    positions = np.arange(len(boundaries)) * block_frames
+
+    def scale(samples, frame, channels):
+        frames = samples.reshape(-1, channels)
+        envelope = np.interp(np.arange(frame, frame + len(frames)), positions, boundaries)
+        scaled = np.rint(frames * envelope[:, None].astype(np.float32))
+        np.clip(scaled, -MAXVALUE - 1, MAXVALUE, out=scaled)
+        return scaled.astype(np.int16).ravel()
+    rewrite(path, scale)
+    return gain
 
-# Using multiprocessing so that large memory use if freed when done.
 def maximize(prefix, fileName):
-    MAXVALUE = 32767
-    if fileName.endswith('.wav'):
-        wf = wave.open(prefix+fileName, 'rb')
-        params = wf.getparams()
-        frameCount = params[3] 
-        sound = wf.readframes(frameCount)
-        wf.close()
-                
-        sound = np.frombuffer(sound, np.int16) 
-        levels = abs(sound)
-        maxVolume = np.max(levels)
-        factor = MAXVALUE / maxVolume
-        sound = sound*factor
-        sound = sound.astype(np.int16)
-        sound = sound.tobytes() 
-                
-        # Save
-        wf = wave.open(prefix+fileName,"wb")
-        wf.setparams(params)
-        wf.writeframes(sound)
-        wf.close()
-
-def multimax(fName):
-    """ opens each wav file in the folder and maximizes the volume"""
+    """Scales a 16-bit wav file so its loudest sample is full scale. The file
+    is read in chunks, twice, so memory use stays small. Returns the gain
+    applied, or None if the file was skipped."""
+    if not fileName.endswith('.wav'):
+        return None
+    path = prefix+fileName
+    with wave.open(path, 'rb') as wf:
+        if wf.getsampwidth() != 2:
+            print(f"Skipping {fileName}: only 16-bit files can be maximized")
+            return None
+    peak = find_peak(path)
+    if peak == 0:
+        print(f"Skipping {fileName}: it is silent")
+        return None
+    gain = MAXVALUE / peak
+    if peak < MAXVALUE:
+        apply_gain(path, gain)
+    return gain
+
+def load_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def mode_key(mode, target=LOUDNESS_TARGET):
+    """How a file was normalized, as recorded in the manifest"""
+    return 'peak' if mode == 'peak' else f"loudness {target:g}"
+
+def is_done(path, entry, mode):
+    """True if the manifest entry shows the file was already normalized this way
+    (mode_key) and hasn't changed since. The hash is only checked if size or
+    mtime differ."""
+    if not entry or entry.get('mode') != mode:
+        return False
+    st = os.stat(path)
+    if (st.st_size, st.st_mtime_ns) == (entry.get('size'), entry.get('mtime_ns')):
+        return True
+    return file_hash(path) == entry.get('hash')
+
+def normalize_file(prefix, fileName, mode='peak', target=LOUDNESS_TARGET):
+    """Normalizes one file and returns its manifest entry. Runs in a worker process."""
+    if mode == 'peak':
+        gain = maximize(prefix, fileName)
+    else:
+        gain = match_loudness(prefix, fileName, target)
+    path = prefix+fileName
+    st = os.stat(path)
+    return {'mode': mode_key(mode, target), 'gain': gain, 'hash': file_hash(path),
+            'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def available_memory():
+    """Memory that can be used without swapping, page cache included
+    (MemAvailable), or None where that isn't known"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # free pages only, so an underestimate; for systems without /proc/meminfo
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None     # not available on this platform
+
+def pool_size():
+    """One worker per CPU, fewer if available memory is short"""
+    workers = os.cpu_count() or 1
+    available = available_memory()
+    if available is not None:
+        workers = min(workers, max(1, available // WORKER_MEMORY))
+    return workers
+
+def print_progress(done, total, fileName, entry, error):
+    if error is not None:
+        print(f"[{done}/{total}] {fileName}: failed ({error})")
+    elif entry['gain'] is None:
+        print(f"[{done}/{total}] {fileName}: skipped")
+    else:
+        print(f"[{done}/{total}] {fileName}: gain {entry['gain']:.2f}")
+
+def multimax(fName, incremental=True, workers=None, progress=print_progress,
+             mode='peak', target=LOUDNESS_TARGET):
+    """ opens each wav file in the folder and maximizes the volume, or with
+    mode='loudness' brings each to the same target loudness. Files are done
+    in parallel; with incremental, files the manifest shows are already done
+    are skipped. Returns the number of files processed."""
+    if mode not in ('peak', 'loudness'):
+        raise ValueError("mode must be 'peak' or 'loudness'")
+    key = mode_key(mode, target)
+    prefix = fName+'/'
+    manifest = load_manifest(fName) if incremental else {}
     with os.scandir(fName) as folder:
-        prefix = fName+'/'
-        for file in folder:
-            p = Process(target=maximize, args=(prefix, file.name,))
-            p.start()
-            p.join()
-                            
+        names = sorted(file.name for file in folder
+                       if file.name.endswith('.wav') and file.is_file())
+    todo = []
+    already = 0
+    for name in names:
+        try:
+            if incremental and is_done(prefix+name, manifest.get(name), key):
+                already += 1
+                continue
+        except OSError as e:
+            print(f"Skipping {name}: {e}")     # gone or unreadable since it was listed
+            continue
+        todo.append(name)
+    if already:
+        print(f"{already} of {len(names)} files in {fName} are already done")
+    if not todo:
+        return 0
+
+    def finished(done, name, entry, error):
+        if error is None:
+            manifest[name] = entry
+            save_manifest(fName, manifest)   # after every file, so an interrupted run resumes
+        progress(done, len(todo), name, entry, error)
+
+    workers = min(workers or pool_size(), len(todo))
+    if workers == 1:
+        for done, name in enumerate(todo, 1):
+            try:
+                finished(done, name, normalize_file(prefix, name, mode, target), None)
+            except (OSError, EOFError, ValueError, wave.Error) as e:
+                finished(done, name, None, e)
+        return len(todo)
+
+    # spawn, not fork: the control panel calling this is a Tk process
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(normalize_file, prefix, name, mode, target): name
+                   for name in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                finished(done, futures[future], future.result(), None)
+            except (OSError, EOFError, ValueError, wave.Error) as e:
+                finished(done, futures[future], None, e)
+    return len(todo)
+
 if __name__ == '__main__':
     getInput = True
     while getInput == True:
@@ -50,7 +320,8 @@ to maximize the volumes of: """)
         if folderName not in ('ambient', 'vocals'):
             print('\nEnter either "ambient" or "vocals" (without quotes)')
         else:
-            getInput = False       
-    multimax(folderName)
-
+            getInput = False
+    mode = input("""Enter "peak" to maximize each file, or "loudness" to bring them all
+to the same loudness (default peak): """).strip() or 'peak'
+    multimax(folderName, mode=mode)
 
@@ -32,6 +32,11 @@ class HardwareBase(ABC):
         """Create a digital output device"""
         pass
     
+    @abstractmethod
+    def create_pwm_output(self, pin):
+        """Create a PWM output device (value 0.0 - 1.0)"""
+        pass
+    
     @abstractmethod
     def is_service_running(self, service_name):
         """Check if a system service is running"""
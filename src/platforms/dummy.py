@@ -72,6 +72,23 @@ class DummyOutput:
     def close(self):
         print(f"[DUMMY] Closing output on pin {self.pin}")
 
+class DummyPWMOutput:
+    """Dummy PWM output implementation"""
+    
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 0.0
+        print(f"[DUMMY] Created PWM output on pin {pin}")
+    
+    def on(self):
+        self.value = 1.0
+    
+    def off(self):
+        self.value = 0.0
+    
+    def close(self):
+        print(f"[DUMMY] Closing PWM output on pin {self.pin}")
+
 class PlatformHardware(HardwareBase):
     """Dummy hardware implementation for unsupported platforms"""
     
@@ -96,6 +113,10 @@ class PlatformHardware(HardwareBase):
         """Create a dummy digital output device"""
         return DummyOutput(pin)
     
+    def create_pwm_output(self, pin):
+        """Create a dummy PWM output device"""
+        return DummyPWMOutput(pin)
+    
     def is_service_running(self, service_name):
         """Check if a system service is running (always returns True in dummy mode)"""
         print(f"[DUMMY] Checking if service {service_name} is running")
@@ -82,6 +82,23 @@ class SoftwareOutput:
     def close(self):
         print(f"[Linux] Closing software output")
 
+class SoftwarePWMOutput:
+    """Software-based PWM output implementation for Linux"""
+    
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 0.0
+        print(f"[Linux] Created software PWM output (pin {pin} is virtual)")
+    
+    def on(self):
+        self.value = 1.0
+    
+    def off(self):
+        self.value = 0.0
+    
+    def close(self):
+        print(f"[Linux] Closing software PWM output")
+
 class PlatformHardware(HardwareBase):
     """Linux specific hardware implementation"""
     
@@ -106,6 +123,10 @@ class PlatformHardware(HardwareBase):
         """Create a software digital output device"""
         return SoftwareOutput(pin)
     
+    def create_pwm_output(self, pin):
+        """Create a software PWM output device"""
+        return SoftwarePWMOutput(pin)
+    
     def is_service_running(self, service_name):
         """Check if a system service is running using systemctl"""
         try:
@@ -86,6 +86,23 @@ class SoftwareOutput:
     def close(self):
         print(f"[macOS] Closing software output")
 
+class SoftwarePWMOutput:
+    """Software-based PWM output implementation for macOS"""
+    
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 0.0
+        print(f"[macOS] Created software PWM output (pin {pin} is virtual)")
+    
+    def on(self):
+        self.value = 1.0
+    
+    def off(self):
+        self.value = 0.0
+    
+    def close(self):
+        print(f"[macOS] Closing software PWM output")
+
 class PlatformHardware(HardwareBase):
     """macOS specific hardware implementation"""
     
@@ -110,6 +127,10 @@ class PlatformHardware(HardwareBase):
         """Create a software digital output device"""
         return SoftwareOutput(pin)
     
+    def create_pwm_output(self, pin):
+        """Create a software PWM output device"""
+        return SoftwarePWMOutput(pin)
+    
     def is_service_running(self, service_name):
         """Check if a system service is running (macOS uses launchd)"""
         try:
@@ -5,10 +5,11 @@ Raspberry Pi specific hardware implementation with simulation support.
 import subprocess
 import time
 import config as c
-from gpiozero.pins.pigpio import PiGPIOFactory
-from gpiozero import Device, AngularServo, Button, DigitalOutputDevice
 from platforms.base import HardwareBase
 
+# gpiozero is imported in setup(), and only when driving real hardware
+gpiozero = None
+
 def default_handler(value): 
     print(f"[default] Setting servo angle to {value}")
 
@@ -78,6 +79,22 @@ class SoftwareOutput:
     def close(self):
         print("Closing simulated output")
 
+class SoftwarePWMOutput:
+    """Software-based PWM output implementation for Raspberry Pi simulation"""
+    
+    def __init__(self):
+        self.value = 0.0
+        print("Created simulated PWM output")
+        
+    def on(self):
+        self.value = 1.0
+        
+    def off(self):
+        self.value = 0.0
+        
+    def close(self):
+        print("Closing simulated PWM output")
+
 class PlatformHardware(HardwareBase):
     """Raspberry Pi specific hardware implementation"""
     
@@ -100,12 +117,15 @@ class PlatformHardware(HardwareBase):
         
     def setup(self):
         """Initialize hardware components"""
+        global gpiozero
         if not self.simulation_mode:
             try:
                 if self.pi_version >= 5:
                     self._check_pigpio_version(min_version="79")
+                import gpiozero
+                from gpiozero.pins.pigpio import PiGPIOFactory
                 self.pin_factory = PiGPIOFactory()
-                Device.pin_factory = self.pin_factory
+                gpiozero.Device.pin_factory = self.pin_factory
             except Exception as e:
                 print(f"Warning: Failed to initialize Pi hardware ({e}), falling back to simulation mode")
                 self.simulation_mode = True
@@ -122,7 +142,7 @@ class PlatformHardware(HardwareBase):
         """Create a servo controller using gpiozero or software implementation"""
         if self.simulation_mode:
             return SoftwareServo(pin, min_angle, max_angle)
-        return AngularServo(
+        return gpiozero.AngularServo(
             pin, 
             min_angle=min_angle, 
             max_angle=max_angle, 
@@ -135,13 +155,19 @@ class PlatformHardware(HardwareBase):
         """Create a button/input device using gpiozero or software implementation"""
         if self.simulation_mode:
             return SoftwareButton()
-        return Button(pin, pull_up=pull_up)
+        return gpiozero.Button(pin, pull_up=pull_up)
     
     def create_output(self, pin):
         """Create a digital output device using gpiozero or software implementation"""
         if self.simulation_mode:
             return SoftwareOutput()
-        return DigitalOutputDevice(pin)
+        return gpiozero.DigitalOutputDevice(pin)
+    
+    def create_pwm_output(self, pin):
+        """Create a PWM output device using gpiozero or software implementation"""
+        if self.simulation_mode:
+            return SoftwarePWMOutput()
+        return gpiozero.PWMOutputDevice(pin)
     
     def is_service_running(self, service_name):
         """Check if a system service is running using systemctl"""
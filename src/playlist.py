@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Playlists for Chatter Pi
+
+Picks the next vocal or ambient bed. PLAYLIST = ORDER plays each folder in
+name order, as before. PLAYLIST = SHUFFLE draws tracks at random, weighted by
+each track's "weight" in the track index (1.0 by default) times the factor
+of every "hours" range it has that contains the current hour, and doesn't
+draw a track played in the last NO_REPEAT picks.
+
+Draws use an alias table, so picking from thousands of tracks costs the same
+as picking from ten; tables are only rebuilt when the library or the hour
+changes. The next track is chosen ahead of time (peek), so the prefetcher
+can load it while the current one plays. Positions, recent picks and the
+chosen next track are saved to playlist.json, so a restart carries on where
+the last run left off.
+
+Run this module (from src) to set weights or preview the shuffle:
+    python playlist.py weight vocals/v03.wav 2 --hours 18-23=3 0-7=0
+    python playlist.py preview -n 20
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from collections import deque
+
+STATE_FILE = 'playlist.json'
+MAX_DRAWS = 32      # alias draws before falling back to a scan of the eligible tracks
+
+
+def hour_weight(entry, hour):
+    """A track's shuffle weight at this hour of the day. An "hours" range
+    "18-23" covers 18:00 to 22:59; "22-6" wraps past midnight. A negative
+    value edited into the index counts as 0."""
+    weight = float(entry.get('weight', 1.0))
+    for span, factor in entry.get('hours', {}).items():
+        start, end = (int(h) for h in span.split('-'))
+        if (start <= hour < end) if start <= end else (hour >= start or hour < end):
+            weight *= max(factor, 0.0)
+    return max(weight, 0.0)
+
+
+class AliasTable:
+    """Draws index i with probability weights[i] / sum(weights) in O(1)
+    (Vose's alias method); building it is O(n)"""
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1
+            (small if scaled[l] < 1 else large).append(l)
+
+    def sample(self, rng):
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+
+class Playlist:
+    """The play order of one track folder"""
+
+    def __init__(self, index, mode='ORDER', no_repeat=0, state=None, rng=None):
+        state = state or {}
+        self.index = index          # trackindex.TrackIndex, for weights and hours
+        self.mode = mode
+        self.no_repeat = no_repeat
+        self.rng = rng or random.Random()
+        self.position = state.get('position', 0)
+        self.upcoming = state.get('upcoming')
+        self.recent = deque(state.get('recent', []), maxlen=max(no_repeat, 0))
+        self.tracks = []
+        self._tables = {}           # hour -> AliasTable, or None if every weight is 0
+
+    def update(self, tracks):
+        """Switches to a new list of track keys (the library changed)"""
+        self.tracks = list(tracks)
+        self._tables.clear()
+        if self.upcoming is not None and self.upcoming not in self.tracks:
+            self.upcoming = None
+
+    def peek(self):
+        """The track that plays next, choosing it if that hasn't been done yet"""
+        if not self.tracks:
+            return None
+        if self.upcoming is None:
+            self.upcoming = self._choose()
+        return self.upcoming
+
+    def advance(self):
+        """Records that the upcoming track has been played"""
+        played, self.upcoming = self.upcoming, None
+        if played is None:
+            return
+        if self.mode == 'ORDER':
+            self.position += 1
+        self.recent.append(played)
+
+    def _choose(self):
+        if self.mode == 'ORDER':
+            self.position %= len(self.tracks)
+            return self.tracks[self.position]
+        hour = time.localtime().tm_hour
+        if hour not in self._tables:
+            weights = [hour_weight(self.index.tracks.get(key, {}), hour) for key in self.tracks]
+            self._tables[hour] = AliasTable(weights) if sum(weights) > 0 else None
+        table = self._tables[hour]
+        # with fewer tracks than NO_REPEAT + 1, only the last few are held back
+        held = min(self.no_repeat, len(self.tracks) - 1)
+        recent = set(list(self.recent)[-held:]) if held > 0 else set()
+        if table is not None:
+            for _ in range(MAX_DRAWS):
+                key = self.tracks[table.sample(self.rng)]
+                if key not in recent:
+                    return key
+        if table is None:       # nothing has weight at this hour; still honour NO_REPEAT
+            return self.rng.choice([key for key in self.tracks if key not in recent])
+        # nearly all the weight was played recently. A weight of 0 means never
+        # at this hour, so the no-repeat rule gives way rather than the weights.
+        weights = {key: hour_weight(self.index.tracks.get(key, {}), hour) for key in self.tracks}
+        eligible = [key for key in self.tracks if weights[key] > 0 and key not in recent]
+        if not eligible:
+            eligible = [key for key in self.tracks if weights[key] > 0]
+        return self.rng.choices(eligible, [weights[key] for key in eligible])[0]
+
+    def state(self):
+        return {'position': self.position, 'upcoming': self.upcoming,
+                'recent': list(self.recent)}
+
+
+def load_state(path=STATE_FILE):
+    """Saved playlist states by folder; empty if there are none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring playlist state {path}: {e}")
+        return {}
+
+
+def save_state(states, path=STATE_FILE):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(states, f)
+    os.replace(path + '.tmp', path)
+
+
+def parse_weight(text):
+    try:
+        weight = float(text)
+        if weight < 0:
+            raise ValueError
+        return weight
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text!r} is not a weight >= 0")
+
+
+def parse_hours(text):
+    """"18-23=3" -> ("18-23", 3.0)"""
+    try:
+        span, factor = text.split('=')
+        start, end = (int(h) for h in span.split('-'))
+        factor = float(factor)
+        if not (0 <= start <= 24 and 0 <= end <= 24) or factor < 0:
+            raise ValueError
+        return f"{start}-{end}", factor
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text!r} is not START-END=FACTOR (hours 0-24, factor >= 0)")
+
+
+def main():
+    import config as c
+    import trackindex
+
+    parser = argparse.ArgumentParser(description='Set shuffle weights or preview the playlist')
+    commands = parser.add_subparsers(dest='command', required=True)
+    weight = commands.add_parser('weight', help="Set a track's shuffle weight")
+    weight.add_argument('track', help='Track path relative to src, e.g. vocals/v03.wav')
+    weight.add_argument('weight', type=parse_weight, help='Relative weight (default for every track is 1)')
+    weight.add_argument('--hours', type=parse_hours, nargs='+', default=None,
+                        help='START-END=FACTOR ranges that multiply the weight, e.g. 18-23=3')
+    preview = commands.add_parser('preview', help='Show the next picks without playing them')
+    preview.add_argument('-n', type=int, default=10, help='Number of picks (default 10)')
+    preview.add_argument('--folder', default='vocals/', help='Track folder (default vocals/)')
+    args = parser.parse_args()
+
+    c.update()
+    index = trackindex.TrackIndex.load()
+    if args.command == 'weight':
+        key = trackindex.track_key(args.track)
+        index.set_schedule(key, args.weight, dict(args.hours) if args.hours else None)
+        index.save()
+        print(f"{key}: weight {args.weight:g}" +
+              ''.join(f", x{f:g} from {span}h" for span, f in (args.hours or [])))
+        return
+
+    index.refresh((args.folder,))
+    playlist = Playlist(index, c.PLAYLIST, c.NO_REPEAT, load_state().get(args.folder))
+    playlist.update(index.library(args.folder))
+    if not playlist.tracks:
+        print(f"No tracks in {args.folder}")
+        return
+    print(f"Next {args.n} of {len(playlist.tracks)} tracks ({c.PLAYLIST}, NO_REPEAT = {c.NO_REPEAT}):")
+    for _ in range(args.n):
+        print(f"  {playlist.peek()}")
+        playlist.advance()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Show timelines for Chatter Pi
+
+A show file is a JSON (or YAML, if PyYAML is installed) list of timed cues:
+
+    {"cues": [
+        {"at": 0.0, "do": "eyes", "value": "on"},
+        {"at": 0.0, "do": "trigger_out", "value": "pulse"},
+        {"at": 0.5, "do": "vocal", "file": "vocals/v01.wav"},
+        {"at": 6.0, "do": "vocal", "file": "vocals/v02.wav"},
+        {"at": 9.0, "do": "servo", "value": 45},
+        {"at": 9.5, "do": "eyes", "value": "off"}
+    ]}
+
+Cue times are converted to frame positions on the output sample clock.
+AUDIO.play_show mixes vocals in at their frame and has the other cues fired
+when their frame reaches the DAC. Running this module directly does a dry
+run that reports the timing error each cue would have for a given block
+size if it were fired at the start of its block instead.
+"""
+
+import argparse
+import json
+import os
+import wave
+
+ACTIONS = ('vocal', 'eyes', 'trigger_out', 'servo')
+SHOW_EXTENSIONS = ('.json', '.yaml', '.yml')
+DEFAULT_RATE = 44100
+
+
+class Cue:
+    """One timed step of a show"""
+    __slots__ = ('time', 'action', 'value', 'frame')
+
+    def __init__(self, time, action, value, frame):
+        self.time = time
+        self.action = action
+        self.value = value
+        self.frame = frame
+
+    def __repr__(self):
+        return f"Cue({self.time:.3f}s, {self.action}, {self.value!r})"
+
+
+class Show:
+    """A parsed show: cues sorted by frame, plus the output format they share"""
+
+    def __init__(self, name, cues, rate, channels, sampwidth, total_frames):
+        self.name = name
+        self.cues = cues
+        self.rate = rate
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.total_frames = total_frames
+
+
+def _read_show_file(path):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required for YAML show files (pip install pyyaml)")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_show(path):
+    """Parses and validates a show file. Vocal paths are relative to the show file
+    unless absolute. All vocals must share one 16-bit format."""
+    data = _read_show_file(path)
+    entries = data.get('cues') if isinstance(data, dict) else data
+    if not entries:
+        raise ValueError(f"{path}: show has no cues")
+
+    base = os.path.dirname(os.path.abspath(path))
+    fmt = None
+    end_time = 0.0
+    raw = []
+    for i, entry in enumerate(entries):
+        action = entry.get('do')
+        if action not in ACTIONS:
+            raise ValueError(f"{path}: cue {i} has unknown action {action!r}")
+        at = float(entry.get('at', 0.0))
+        if at < 0:
+            raise ValueError(f"{path}: cue {i} has a negative time")
+        if action == 'vocal':
+            value = entry['file']
+            if not os.path.isabs(value):
+                value = os.path.join(base, value)
+            with wave.open(value, 'rb') as wf:
+                params = (wf.getframerate(), wf.getnchannels(), wf.getsampwidth())
+                duration = wf.getnframes() / wf.getframerate()
+            if params[2] != 2:
+                raise ValueError(f"{value}: only 16-bit WAV files can be used in a show")
+            if fmt is None:
+                fmt = params
+            elif params != fmt:
+                raise ValueError(f"{value}: format {params} differs from the show's {fmt}")
+            end_time = max(end_time, at + duration)
+        elif action == 'servo':
+            value = None if entry.get('value') is None else float(entry['value'])
+        else:
+            value = str(entry.get('value', 'on')).lower()
+            if value not in ('on', 'off', 'pulse'):
+                raise ValueError(f"{path}: cue {i} value must be on, off or pulse")
+        end_time = max(end_time, at)
+        raw.append((at, i, action, value))
+
+    rate, channels, sampwidth = fmt if fmt else (DEFAULT_RATE, 1, 2)
+    cues = [Cue(at, action, value, round(at * rate))
+            for at, i, action, value in sorted(raw)]
+    return Show(os.path.basename(path), cues, rate, channels, sampwidth,
+                round(end_time * rate))
+
+
+def dry_run(show, block_size):
+    """Works out when each cue would fire for a given callback block size.
+    Vocals are mixed in at their exact frame; other cues fire at the start
+    of the block containing them, so their error is between zero and one
+    block early. Returns a list of (cue, error_seconds)."""
+    results = []
+    for cue in show.cues:
+        if cue.action == 'vocal':
+            results.append((cue, 0.0))
+            continue
+        block_start = (cue.frame // block_size) * block_size
+        results.append((cue, (block_start - cue.frame) / show.rate))
+    return results
+
+
+def print_timing(show, results, label):
+    """Prints a per-cue timing table"""
+    print(f"\n{label} for {show.name} ({show.rate} Hz, "
+          f"{show.total_frames / show.rate:.2f} s)")
+    print(f"{'time (s)':>9}  {'action':<12} {'error (ms)':>10}  value")
+    worst = 0.0
+    for cue, error in results:
+        worst = max(worst, abs(error))
+        value = os.path.basename(cue.value) if cue.action == 'vocal' else cue.value
+        print(f"{cue.time:9.3f}  {cue.action:<12} {error * 1000:10.2f}  {value}")
+    print(f"Worst cue error: {worst * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dry run a Chatter Pi show file')
+    parser.add_argument('showfile', help='JSON or YAML show file')
+    parser.add_argument('-b', '--buffer-size', type=int, default=None,
+                        help='Callback block size in frames (default: BUFFER_SIZE from config.ini)')
+    args = parser.parse_args()
+
+    block_size = args.buffer_size
+    if block_size is None:
+        import config as c
+        c.update()
+        block_size = c.BUFFER_SIZE
+    show = load_show(args.showfile)
+    print_timing(show, dry_run(show, block_size), f"Dry run ({block_size}-frame blocks)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Startup-time profiling for Chatter Pi (main.py --profile-startup)
+
+While enabled, every first-time import is timed (including the imports it
+triggers) and code wrapped in step() is recorded as an initialization step.
+step() costs nothing when profiling is off.
+"""
+
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+
+enabled = False
+imports = []    # (depth, module, seconds) in completion order
+steps = []      # (name, seconds)
+_start = None
+_depth = 0
+_real_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    if level or name in sys.modules:
+        return _real_import(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    _depth += 1
+    try:
+        return _real_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        imports.append((_depth, name, time.perf_counter() - start))
+
+
+def enable():
+    """Start timing imports and steps"""
+    global enabled, _start
+    enabled = True
+    _start = time.perf_counter()
+    builtins.__import__ = _timed_import
+
+
+@contextmanager
+def step(name):
+    """Times the enclosed block as an initialization step"""
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        steps.append((name, time.perf_counter() - start))
+
+
+def report(max_depth=1, min_ms=1.0):
+    """Prints import and initialization times; nested imports are indented
+    under the import that pulled them in."""
+    builtins.__import__ = _real_import
+    total = time.perf_counter() - _start
+    print("\nStartup profile")
+    print("===============")
+    print("Imports (ms, including nested imports):")
+    # imports complete innermost first; reverse so parents print above children
+    for depth, name, seconds in reversed(imports):
+        if depth <= max_depth and seconds * 1000 >= min_ms:
+            print(f"  {'  ' * depth}{seconds * 1000:8.1f}  {name}")
+    print("Initialization (ms):")
+    for name, seconds in steps:
+        print(f"  {seconds * 1000:8.1f}  {name}")
+    print(f"Total: {total * 1000:.1f} ms")
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Track index for Chatter Pi
+
+An index file (trackindex.json, next to config.ini) holds what is known
+about each track ahead of time, keyed by its path relative to src
+("vocals/v01.wav"). It is loaded once at startup, so looking a track up
+when a trigger fires is a dict access with no file I/O.
+
+The index doubles as the track library: refresh() diffs the track folders
+against it with os.scandir, and only files that are new or whose size or
+mtime changed are opened to read their duration and format. A folder
+whose own mtime is unchanged (no file added, removed or replaced) is not
+listed at all. Content hashes are filled in later, in the background.
+
+A track's "profile" holds the settings to use while it plays: any of the
+[CONTROLLER] settings (STYLE, THRESHOLD, LEVEL1, ...) and GAIN, a playback
+gain in dB. Profiles are written offline by utils/calibrate.py --per-track.
+Its "weight" and "hours" steer the shuffle (see playlist.py).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import wave
+
+INDEX_FILE = 'trackindex.json'
+VERSION = 1
+AUDIO_EXTENSIONS = ('.wav',)    # what audio.py can play
+
+# what the user set for a track, kept when the file changes or goes away
+USER_KEYS = ('profile', 'weight', 'hours')
+
+# settings a profile may hold, besides GAIN
+PROFILE_FIELDS = ('STYLE', 'THRESHOLD', 'LEVEL1', 'LEVEL2', 'LEVEL3',
+                  'FILTERED_LEVEL1', 'FILTERED_LEVEL2', 'FILTERED_LEVEL3')
+
+
+def track_key(path, root='.'):
+    """Index key of a track: its path relative to root (the src directory),
+    with forward slashes"""
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def probe(path):
+    """Duration and format of a WAV file, from its header"""
+    with wave.open(path, 'rb') as wf:
+        rate = wf.getframerate()
+        return {'duration': wf.getnframes() / rate if rate else 0.0,
+                'channels': wf.getnchannels(), 'rate': rate,
+                'sampwidth': wf.getsampwidth()}
+
+
+def file_hash(path):
+    """BLAKE2b hash of a file's contents, read in chunks"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TrackIndex:
+    """Per-track entries, loaded from and saved to an index file"""
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self.tracks = {}
+        self.folders = {}       # folder -> its mtime_ns when last scanned
+        self.dirty = False      # changed since loaded or saved
+        self._edited = set()    # tracks whose USER_KEYS this process has set
+        self._lock = threading.Lock()
+        self._saver = None
+
+    @classmethod
+    def load(cls, path=INDEX_FILE):
+        """Reads the index; a missing or unreadable file gives an empty one"""
+        index = cls(path)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return index
+        except (OSError, ValueError) as e:
+            print(f"Ignoring track index {path}: {e}")
+            return index
+        if data.get('version') == VERSION:
+            index.tracks = data.get('tracks', {})
+            index.folders = data.get('folders', {})
+        return index
+
+    def _read_tracks(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data.get('tracks', {}) if data.get('version') == VERSION else {}
+
+    def save(self):
+        """Writes the index. Profiles and weights saved to the file by another
+        process since it was loaded (calibrate.py or playlist.py while
+        ChatterPi runs) are merged in first rather than overwritten; only the
+        tracks this process set them on keep its own values."""
+        with self._lock:
+            for key, entry in self._read_tracks().items():
+                if key in self._edited:
+                    continue
+                user = {k: v for k, v in entry.items() if k in USER_KEYS}
+                mine = self.tracks.get(key)
+                if mine is None:
+                    if user:
+                        self.tracks[key] = user
+                    continue
+                for k in USER_KEYS:
+                    if k in user:
+                        mine[k] = user[k]
+                    else:
+                        mine.pop(k, None)
+            data = json.dumps({'version': VERSION, 'folders': self.folders,
+                               'tracks': self.tracks}, separators=(',', ':'))
+            self.dirty = False
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+    def profile(self, key):
+        """The track's profile, or None"""
+        entry = self.tracks.get(key)
+        return entry.get('profile') if entry is not None else None
+
+    def set_profile(self, key, profile):
+        unknown = set(profile) - set(PROFILE_FIELDS) - {'GAIN'}
+        if unknown:
+            raise ValueError(f"Unknown profile settings: {', '.join(sorted(unknown))}")
+        with self._lock:
+            self.tracks.setdefault(key, {})['profile'] = dict(profile)
+            self._edited.add(key)
+            self.dirty = True
+
+    def set_schedule(self, key, weight=None, hours=None):
+        """Sets a track's shuffle weight and its {"18-23": 3.0} hour-range
+        weight multipliers. None leaves a value as it is."""
+        if weight is not None and weight < 0:
+            raise ValueError("A weight can't be negative")
+        if hours is not None and any(factor < 0 for factor in hours.values()):
+            raise ValueError("An hours factor can't be negative")
+        with self._lock:
+            entry = self.tracks.setdefault(key, {})
+            if weight is not None:
+                entry['weight'] = float(weight)
+            if hours is not None:
+                entry['hours'] = dict(hours)
+            self._edited.add(key)
+            self.dirty = True
+
+    def refresh(self, folders, force=False):
+        """Brings the index up to date with the files in folders (paths
+        relative to src). Returns True if any track was added, removed or
+        changed."""
+        changed = False
+        for folder in folders:
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                mtime = None
+            if not force and folder in self.folders and self.folders[folder] == mtime:
+                continue
+            scanned = self._scan(folder)
+            with self._lock:
+                if scanned or self.folders.get(folder) != mtime:
+                    self.folders[folder] = mtime
+                    self.dirty = True
+            changed |= scanned
+        return changed
+
+    def _scan(self, folder):
+        """Diffs one folder against the index"""
+        prefix = track_key(folder) + '/'
+        seen = set()
+        changed = False
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.name.lower().endswith(AUDIO_EXTENSIONS) or not entry.is_file():
+                        continue
+                    key = prefix + entry.name
+                    seen.add(key)
+                    st = entry.stat()
+                    known = self.tracks.get(key, {})
+                    if (known.get('size'), known.get('mtime_ns')) == (st.st_size, st.st_mtime_ns):
+                        continue
+                    new = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': None}
+                    try:
+                        new.update(probe(entry.path))
+                    except (OSError, EOFError, wave.Error) as e:
+                        print(f"Skipping {entry.path}: {e}")
+                        new['error'] = str(e) or type(e).__name__   # not probed again until it changes
+                    new.update((k, known[k]) for k in USER_KEYS if k in known)
+                    with self._lock:
+                        self.tracks[key] = new
+                    changed = True
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            for key in [k for k, e in self.tracks.items()
+                        if k.startswith(prefix) and 'size' in e and k not in seen]:
+                kept = {k: v for k, v in self.tracks[key].items() if k in USER_KEYS}
+                if kept:
+                    self.tracks[key] = kept     # in case it comes back
+                else:
+                    del self.tracks[key]
+                changed = True
+        return changed
+
+    def library(self, folder):
+        """Keys of the playable tracks in folder, sorted by name"""
+        prefix = track_key(folder) + '/'
+        return sorted(key for key, entry in self.tracks.items()
+                      if key.startswith(prefix) and 'size' in entry and 'error' not in entry)
+
+    def fill_hashes(self):
+        """Hashes the tracks that don't have one yet"""
+        for key, entry in list(self.tracks.items()):
+            if 'size' not in entry or 'error' in entry or entry.get('hash'):
+                continue
+            try:
+                digest = file_hash(key)
+            except OSError:
+                continue
+            with self._lock:
+                if self.tracks.get(key) is entry:
+                    entry['hash'] = digest
+
+    def save_in_background(self):
+        """Hashes new tracks and saves the index in a background thread"""
+        if self._saver is not None and self._saver.is_alive():
+            return
+        def hash_and_save():
+            self.fill_hashes()
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Could not save track index {self.path}: {e}")
+        self._saver = threading.Thread(target=hash_and_save, daemon=True)
+        self._saver.start()
@@ -1,48 +1,125 @@
 import os
+import time
+import wave
+import threading
+import config as c
 import control
+import audio
+import jawtrack
+import playlist
+import trackindex
 
 class Tracks:
     def __init__(self):
-        self.vocalTrackPos = 0
         self.vocalTrackLocation = 'vocals/'
-        self.ambientTrackPos = 0
         self.ambientTrackLocation = 'ambient/'
-        self.tracksDic = {1:'01', 2: '02', 3: '03', 4: '04', 5: '05', 6: '06',
-                         7: '07', 8: '08', 9: '09', 10: '10'}
-        # Determine which, if any, files are present
+        # every .wav file in the track folders. The index (with the per-track
+        # profiles) is loaded once, so a trigger needs no extra I/O; only new
+        # or changed files are probed.
+        self.index = trackindex.TrackIndex.load()
+        # what plays next (in name order or shuffled), carried over from the last run
+        state = playlist.load_state()
+        self.vocals = playlist.Playlist(self.index, c.PLAYLIST, c.NO_REPEAT,
+                                        state.get(self.vocalTrackLocation))
+        self.ambients = playlist.Playlist(self.index, c.PLAYLIST, c.NO_REPEAT,
+                                          state.get(self.ambientTrackLocation))
         self.vocalList = []
         self.ambientList = []
-        for i in range(1,11):
-            vocalTrackFile = self.vocalTrackLocation+'v'+self.tracksDic[i]+'.wav'
-            if os.path.isfile(vocalTrackFile):
-                self.vocalList.append(i)      
-            ambientTrackFile = self.ambientTrackLocation+'a'+self.tracksDic[i]+'.wav'
-            if os.path.isfile(ambientTrackFile):
-                self.ambientList.append(i)
-
-    def play_vocal(self):
+        self.rescan(force=True)
+
+        # next vocal, prepared in the background so a trigger only has to start it
+        self.prepared = None
+        self.prepareOpened = None   # threading.Event, set once self.prepared is usable
+
+    def rescan(self, force=False):
+        """Picks up files added to, changed in or removed from the track
+        folders. When nothing changed this is one stat per folder."""
+        folders = (self.vocalTrackLocation, self.ambientTrackLocation)
+        if self.index.refresh(folders, force) or force:
+            self.vocalList = self.index.library(self.vocalTrackLocation)
+            self.ambientList = self.index.library(self.ambientTrackLocation)
+            self.vocals.update(self.vocalList)
+            self.ambients.update(self.ambientList)
+        if self.index.dirty:
+            self.index.save_in_background()
+
+    def save_playlists(self):
+        """Saves what plays next, so a restart carries on from here"""
+        try:
+            playlist.save_state({self.vocalTrackLocation: self.vocals.state(),
+                                 self.ambientTrackLocation: self.ambients.state()})
+        except OSError as e:
+            print(f"Could not save {playlist.STATE_FILE}: {e}")
+
+    def next_vocal_file(self):
+        """The vocal the playlist will play next; choosing it early lets
+        prefetch_vocal load it"""
+        return self.vocals.peek()
+
+    def prefetch_vocal(self):
+        """Starts preparing the next vocal (header parsed, first seconds of PCM
+        read, jaw track computed) in a background thread, during ambient
+        playback or idle time. The track can be taken once it is open; its
+        jaw track is used only if it was computed by then."""
+        if self.vocalList == [] or self.prepareOpened is not None:
+            return
+        vocalTrackFile = self.next_vocal_file()
+        opened = self.prepareOpened = threading.Event()
+        def prepare():
+            try:
+                prepared = audio.PreparedTrack(vocalTrackFile, c.PREFETCH_SECONDS)
+            except (OSError, EOFError, wave.Error) as e:
+                print(f"Could not prepare {vocalTrackFile}: {e}")
+                self.prepared = None
+                opened.set()
+                return
+            self.prepared = prepared
+            opened.set()
+            profile = self.index.profile(vocalTrackFile) or {}
+            try:
+                prepared.jaw_track = jawtrack.compute_jaw_track(
+                    vocalTrackFile, c.BUFFER_SIZE, profile.get('STYLE', c.STYLE))
+            except (OSError, EOFError, wave.Error, ValueError) as e:
+                print(f"Could not precompute the jaw for {vocalTrackFile} ({e}); analyzing live")
+        threading.Thread(target=prepare, daemon=True).start()
+
+    def take_prepared(self, vocalTrackFile):
+        """Returns the prepared track if it matches, else the plain filename.
+        Waits for the file to be opened, not for its jaw track."""
+        if self.prepareOpened is not None:
+            self.prepareOpened.wait()
+            self.prepareOpened = None
+        prepared, self.prepared = self.prepared, None
+        if prepared is not None:
+            if prepared.filename == vocalTrackFile:
+                return prepared
+            prepared.close()
+        return vocalTrackFile
+
+    def play_vocal(self, trigger_time=None):
+        self.rescan()
         if self.vocalList != []:
-            vocalFileName = 'v'+self.tracksDic[self.vocalList[self.vocalTrackPos]]+'.wav'
-            vocalTrackFile = self.vocalTrackLocation+vocalFileName
-            control.a.play_vocal_track(vocalTrackFile)
-            if self.vocalTrackPos == len(self.vocalList) - 1:
-                self.vocalTrackPos = 0
-            else:
-                self.vocalTrackPos += 1
+            vocalTrackFile = self.next_vocal_file()
+            track = self.take_prepared(vocalTrackFile)
+            jaw_track = getattr(track, 'jaw_track', None)
+            profile = self.index.profile(vocalTrackFile)
+            control.a.play_vocal_track(track, trigger_time, jaw_track, profile=profile)
+            self.vocals.advance()
+            self.prefetch_vocal()
+            self.save_playlists()
               
-    def play_file(self, full_path_wavfile):
+    def play_file(self, full_path_wavfile, trigger_time=None, jaw_track=None):
         if os.path.isfile(full_path_wavfile):
-            control.a.play_vocal_track(full_path_wavfile)
+            control.a.play_vocal_track(full_path_wavfile, trigger_time, jaw_track)
               
     def play_ambient(self):
-        while control.ambient_interrupt == False:
+        while not control.arbiter.pending():
+            self.rescan()
             if self.ambientList != []:
-                ambientFileName = 'a'+self.tracksDic[self.ambientList[self.ambientTrackPos]]+'.wav'
-                ambientTrackFile = self.ambientTrackLocation+ambientFileName
+                ambientTrackFile = self.ambients.peek()
                 control.a.play_ambient_track(ambientTrackFile)
-                if self.ambientTrackPos == len(self.ambientList) - 1:
-                    self.ambientTrackPos = 0
-                else:
-                    self.ambientTrackPos += 1
-            
+                self.ambients.advance()
+                self.save_playlists()
+            else:
+                time.sleep(0.1)
 
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Trigger arbitration for Chatter Pi
+
+Triggers (PIR, timer, socket) are timestamped as they arrive and
+passed through a per-source debounce and a global cooldown. Accepted
+triggers are queued by priority; a trigger with a high enough priority
+can cut into a vocal that is already playing.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+# Default priority for each trigger source (higher wins)
+PRIORITIES = {'PIR': 1, 'TIMER': 1, 'SOCKET': 3}
+
+
+# how a trigger ended, set just before its `finished` event
+OUTCOMES = ('played', 'preempted', 'failed', 'evicted')
+
+
+class TriggerEvent:
+    """A single trigger, stamped with the time it arrived"""
+    __slots__ = ('source', 'priority', 'timestamp', 'payload', 'finished', 'outcome')
+
+    def __init__(self, source, priority, payload=None):
+        self.source = source
+        self.priority = priority
+        self.timestamp = time.monotonic()
+        self.payload = payload
+        self.finished = threading.Event()
+        self.outcome = None     # one of OUTCOMES once finished
+
+    @property
+    def played(self):
+        """True if the show ran to the end"""
+        return self.outcome == 'played'
+
+
+class TriggerArbiter:
+    """Debounces, queues and prioritizes incoming triggers.
+
+    debounce         -- dict of source -> seconds; repeats from the same
+                        source inside this window are ignored
+    cooldown         -- seconds after a show ends during which ordinary
+                        triggers are dropped
+    max_queue        -- how many triggers may wait while a show is running
+    preempt_priority -- triggers at or above this priority skip the
+                        cooldown and interrupt a lower priority show
+    """
+
+    def __init__(self, debounce=None, cooldown=0.0, max_queue=1, preempt_priority=3):
+        self.debounce = debounce or {}
+        self.cooldown = cooldown
+        self.max_queue = max_queue
+        self.preempt_priority = preempt_priority
+        # hooks, called with the arbiter's lock held (so they must be quick):
+        self.on_preempt = None      # the running show must stop
+        self.on_start = None        # a trigger has become the running show
+
+        self._cond = threading.Condition()
+        self._queue = []            # heap of (-priority, seq, event)
+        self._seq = itertools.count()
+        self._last_seen = {}
+        self._active = None
+        self._cooldown_until = 0.0
+
+        # metrics
+        self.counts = {'submitted': 0, 'accepted': 0, 'debounced': 0,
+                       'cooldown': 0, 'overflow': 0, 'preempted': 0}
+        self.max_depth = 0
+        self.wait_times = deque(maxlen=100)
+
+    def submit(self, source, priority=None, payload=None):
+        """Offer a trigger. Returns the queued TriggerEvent, or None if dropped."""
+        if priority is None:
+            priority = PRIORITIES.get(source, 1)
+        event = TriggerEvent(source, priority, payload)
+        with self._cond:
+            self.counts['submitted'] += 1
+            now = event.timestamp
+            last = self._last_seen.get(source)
+            if last is not None and now - last < self.debounce.get(source, 0.0):
+                self.counts['debounced'] += 1
+                return None
+            self._last_seen[source] = now
+
+            urgent = priority >= self.preempt_priority
+            if not urgent and self._active is None and now < self._cooldown_until:
+                self.counts['cooldown'] += 1
+                return None
+
+            if len(self._queue) >= self.max_queue:
+                # make room only by evicting something less important
+                lowest = max(self._queue) if self._queue else None
+                if lowest is None or -lowest[0] >= priority:
+                    self.counts['overflow'] += 1
+                    return None
+                self._queue.remove(lowest)
+                heapq.heapify(self._queue)
+                lowest[2].outcome = 'evicted'     # never ran
+                lowest[2].finished.set()
+                self.counts['overflow'] += 1
+
+            heapq.heappush(self._queue, (-priority, next(self._seq), event))
+            self.counts['accepted'] += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            if urgent and self._active is not None and priority > self._active.priority:
+                self.counts['preempted'] += 1
+                # under the lock, so the stop can't land on the show started next
+                if self.on_preempt is not None:
+                    self.on_preempt()
+            self._cond.notify_all()
+        return event
+
+    def _ready(self):
+        if not self._queue:
+            return False
+        if -self._queue[0][0] >= self.preempt_priority:
+            return True
+        return time.monotonic() >= self._cooldown_until
+
+    def pending(self):
+        """True if a trigger is waiting and allowed to run now"""
+        with self._cond:
+            return self._ready()
+
+    def get(self, timeout=None):
+        """Block until a trigger may run; returns it (now active) or None on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._ready():
+                wait = None
+                if self._queue:
+                    wait = max(self._cooldown_until - time.monotonic(), 0.0)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+            event = heapq.heappop(self._queue)[2]
+            self.wait_times.append(time.monotonic() - event.timestamp)
+            self._active = event
+            if self.on_start is not None:
+                self.on_start()
+            return event
+
+    def done(self, event, outcome='played'):
+        """Mark a trigger's show as finished (with one of OUTCOMES) and start
+        the cooldown"""
+        with self._cond:
+            if self._active is event:
+                self._active = None
+            self._cooldown_until = time.monotonic() + self.cooldown
+            self._cond.notify_all()
+        event.outcome = outcome
+        event.finished.set()
+
+    def stats(self):
+        """Return counters, queue depth and wait-time figures"""
+        with self._cond:
+            waits = list(self.wait_times)
+            stats = dict(self.counts)
+            stats['queue_depth'] = len(self._queue)
+            stats['max_depth'] = self.max_depth
+        stats['avg_wait'] = sum(waits) / len(waits) if waits else 0.0
+        stats['max_wait'] = max(waits) if waits else 0.0
+        return stats
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming playback of WAV files that are still being written
+
+GrowingWavReader follows a file as its producer appends to it (like tail -f)
+and feeds a jitter buffer that the audio callback reads from, so playback
+can start once the header and the first fraction of a second of PCM exist.
+"""
+
+import threading
+import time
+
+UNDERRUN_POLICIES = ('REBUFFER', 'SILENCE')
+MAX_POLL_INTERVAL = 0.2     # seconds between polls once the file has stopped growing
+UNKNOWN_SIZES = (0, 0xFFFFFFFF)     # data sizes writers use until they know the real one
+
+
+def read_header(f):
+    """Parses the RIFF header of an open file. Returns (channels, sampwidth,
+    rate, data_offset), or None if the header hasn't been written yet."""
+    f.seek(0)
+    riff = f.read(12)
+    if len(riff) < 12:
+        return None
+    if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError("not a WAV file")
+    fmt = None
+    offset = 12
+    while True:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_size = int.from_bytes(header[4:8], 'little')
+        offset += 8
+        if header[:4] == b'fmt ':
+            body = f.read(16)
+            if len(body) < 16:
+                return None
+            if int.from_bytes(body[0:2], 'little') not in (1, 0xFFFE):
+                raise ValueError("only PCM WAV files can be streamed")
+            channels = int.from_bytes(body[2:4], 'little')
+            rate = int.from_bytes(body[4:8], 'little')
+            sampwidth = int.from_bytes(body[14:16], 'little') // 8
+            fmt = (channels, sampwidth, rate)
+        elif header[:4] == b'data':
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            return fmt + (offset,)
+        offset += chunk_size + (chunk_size & 1)
+
+
+class GrowingWavReader:
+    """Wave-reader-like access to a WAV file while it is being written.
+
+    start_seconds -- PCM to buffer before playback may start
+    underrun      -- 'REBUFFER': play silence until start_seconds are buffered
+                     again; 'SILENCE': pad with silence and play whatever arrives
+    idle_timeout  -- if the file stops growing for this long, it is treated
+                     as finished (when nobody calls mark_complete)
+
+    Reads stop at the end of the data chunk once its size is in the header,
+    so chunks written after it (LIST, id3) aren't played. Polling backs off
+    from poll_interval to MAX_POLL_INTERVAL while the file isn't growing.
+    """
+
+    def __init__(self, filename, start_seconds=0.5, underrun='REBUFFER',
+                 idle_timeout=2.0, poll_interval=0.02):
+        if underrun not in UNDERRUN_POLICIES:
+            raise ValueError(f"underrun policy must be one of {', '.join(UNDERRUN_POLICIES)}")
+        self.filename = filename
+        self.start_seconds = start_seconds
+        self.underrun = underrun
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.underruns = 0
+        self.error = None
+
+        self.channels = self.sampwidth = self.rate = None
+        self.frame_size = 0
+        self.start_bytes = 0
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._header = threading.Event()    # format known (or the file failed)
+        self._complete = threading.Event()  # producer finished writing
+        self._eof = False                   # everything written has been buffered
+        self._rebuffering = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+        self._thread.start()
+
+    def _follow(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                header = None
+                interval = self.poll_interval
+                while header is None:
+                    header = read_header(f)
+                    if header is None:
+                        if self._closed or self._complete.is_set():
+                            raise ValueError("file ended before its header was complete")
+                        time.sleep(interval)
+                        interval = min(interval * 2, MAX_POLL_INTERVAL)
+                self.channels, self.sampwidth, self.rate, data_offset = header
+                self.frame_size = self.channels * self.sampwidth
+                self.start_bytes = int(self.start_seconds * self.rate) * self.frame_size
+                self._header.set()
+
+                position = data_offset
+                last_growth = time.monotonic()
+                interval = self.poll_interval
+                partial = b''
+                while not self._closed:
+                    complete = self._complete.is_set()
+                    f.seek(data_offset - 4)
+                    size = int.from_bytes(f.read(4), 'little')
+                    f.seek(position)
+                    if size in UNKNOWN_SIZES:
+                        data = f.read()
+                    else:
+                        data = f.read(max(data_offset + size - position, 0))
+                    if data:
+                        position += len(data)
+                        last_growth = time.monotonic()
+                        interval = self.poll_interval
+                        data = partial + data
+                        whole = len(data) - len(data) % self.frame_size
+                        partial = data[whole:]
+                        with self._lock:
+                            self._buffer += data[:whole]
+                            if len(self._buffer) >= self.start_bytes:
+                                self._ready.set()
+                    elif complete or time.monotonic() - last_growth > self.idle_timeout:
+                        break
+                    else:
+                        time.sleep(interval)
+                        interval = min(interval * 2, MAX_POLL_INTERVAL)
+        except (OSError, ValueError) as e:
+            self.error = e
+        self._eof = True
+        self._header.set()
+        self._ready.set()
+
+    def mark_complete(self):
+        """Tells the reader the producer has finished writing the file"""
+        self._complete.set()
+
+    def wait_header(self, timeout=None):
+        """Blocks until the format is known. Returns False if the header
+        couldn't be read (see error) or didn't arrive in time."""
+        self._header.wait(timeout)
+        return self.error is None and self.channels is not None
+
+    def wait_ready(self, timeout=None):
+        """Blocks until enough PCM is buffered to start (or the file ended).
+        Raises the error if the file could not be read."""
+        self._ready.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self._ready.is_set()
+
+    def getnchannels(self):
+        return self.channels
+
+    def getsampwidth(self):
+        return self.sampwidth
+
+    def getframerate(self):
+        return self.rate
+
+    def readframes(self, n):
+        """Called from the audio callback; never blocks on the file"""
+        want = n * self.frame_size
+        with self._lock:
+            available = len(self._buffer)
+            if self._rebuffering and not self._eof and available < self.start_bytes:
+                return bytes(want)
+            self._rebuffering = False
+            if available >= want or self._eof:
+                data = bytes(self._buffer[:want])
+                del self._buffer[:want]
+                return data      # a short read at the end stops the stream
+            # underrun: the producer hasn't caught up
+            self.underruns += 1
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            if self.underrun == 'REBUFFER':
+                self._rebuffering = True
+            return data + bytes(want - len(data))
+
+    def wait_written(self):
+        """Blocks until the producer has finished and everything is buffered"""
+        self._thread.join()
+
+    def close(self):
+        self._closed = True
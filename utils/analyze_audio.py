@@ -5,18 +5,28 @@ Audio Analysis Tool for Chatter Pi
 
 This utility analyzes audio files to help with configuring
 threshold levels for jaw movement.
+
+With --all, files are analyzed in parallel (both unfiltered and filtered)
+and the results are cached by content hash, so a re-run only analyzes new
+or changed files. A summary table covers the whole library.
 """
 
-import wave
-import numpy as np
 import matplotlib.pyplot as plt
 import argparse
 import os
 import sys
+import json
+import statistics
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Add the src directory to the path to find the bandpassFilter module
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
 from bandpassFilter import BPFilter
+from audio_stats import scan, ENVELOPE_SECONDS, PLOT_POINTS
+from trackindex import file_hash
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'chatterpi', 'analysis.json')
+CACHE_VERSION = 1   # bump when the analysis itself changes
 
 def analyze_audio(filename, filtered=False):
     """Analyze an audio file and display statistics and visualization"""
@@ -25,42 +35,20 @@ def analyze_audio(filename, filtered=False):
         return
     
     try:
-        # Open the wave file
-        wf = wave.open(filename, 'rb')
-        
-        # Get basic info
-        channels = wf.getnchannels()
-        sample_width = wf.getsampwidth()
-        frame_rate = wf.getframerate()
-        n_frames = wf.getnframes()
-        duration = n_frames / frame_rate
-        
-        # Read all frames
-        frames = wf.readframes(n_frames)
-        wf.close()
-        
-        # Convert to numpy array
-        samples = np.frombuffer(frames, dtype=np.int16)
-        
-        # If stereo, use right channel for analysis (same as in audio.py)
-        if channels == 2:
-            samples = samples[1::2]
-        
-        # Apply bandpass filter if requested
-        if filtered:
-            bp = BPFilter()
-            samples = bp.filter_data(samples)
-        
-        # Calculate statistics
-        abs_samples = np.abs(samples)
-        max_volume = np.max(abs_samples)
-        avg_volume = np.mean(abs_samples)
-        
-        # Calculate percentiles for threshold recommendations
-        p25 = np.percentile(abs_samples, 25)
-        p50 = np.percentile(abs_samples, 50)
-        p75 = np.percentile(abs_samples, 75)
-        p90 = np.percentile(abs_samples, 90)
+        # Read the file in chunks, collecting statistics as we go
+        stats = scan(filename, BPFilter() if filtered else None)
+        channels = stats.channels
+        sample_width = stats.sample_width
+        frame_rate = stats.frame_rate
+        duration = stats.duration
+        max_volume = stats.max_volume
+        avg_volume = stats.avg_volume
+
+        # Percentiles for threshold recommendations, from the histogram
+        p25 = stats.percentile(25)
+        p50 = stats.percentile(50)
+        p75 = stats.percentile(75)
+        p90 = stats.percentile(90)
         
         # Print analysis
         print(f"\nAudio Analysis for: {filename}")
@@ -89,25 +77,20 @@ def analyze_audio(filename, filtered=False):
         # Create visualization
         plt.figure(figsize=(12, 8))
         
-        # Plot waveform
+        # Plot waveform (min/max of each plotted point)
         plt.subplot(2, 1, 1)
-        plt.plot(np.arange(len(samples)) / frame_rate, samples)
+        plt.fill_between(stats.times(len(stats.wave_min)), stats.wave_min, stats.wave_max,
+                         linewidth=0.5)
         plt.title('Waveform')
         plt.xlabel('Time (s)')
         plt.ylabel('Amplitude')
         plt.grid(True)
         
-        # Plot volume envelope
+        # Plot volume envelope (50ms rolling mean, min/max of each plotted point)
         plt.subplot(2, 1, 2)
-        
-        # Calculate envelope (using rolling window)
-        window_size = int(frame_rate * 0.05)  # 50ms window
-        if window_size > 0:
-            envelope = np.zeros(len(abs_samples) - window_size + 1)
-            for i in range(len(envelope)):
-                envelope[i] = np.mean(abs_samples[i:i+window_size])
-            
-            plt.plot(np.arange(len(envelope)) / frame_rate, envelope)
+        if len(stats.env_max):
+            plt.fill_between(stats.times(len(stats.env_max)), stats.env_min, stats.env_max,
+                             linewidth=0.5)
             
             # Add threshold lines
             plt.axhline(y=p25, color='g', linestyle='--', label=f'25% ({int(p25)})')
@@ -129,6 +112,130 @@ def analyze_audio(filename, filtered=False):
     except Exception as e:
         print(f"Error analyzing file: {e}")
 
+def summarize(stats):
+    """The cacheable part of an AudioStats"""
+    return {'max': float(stats.max_volume), 'avg': stats.avg_volume,
+            'p25': stats.percentile(25), 'p50': stats.percentile(50),
+            'p75': stats.percentile(75), 'p90': stats.percentile(90),
+            'bucket': stats.bucket,
+            'env_min': [int(v) for v in stats.env_min],
+            'env_max': [int(v) for v in stats.env_max]}
+
+def analyze_file(filepath):
+    """Unfiltered and filtered analysis of one file, with the recommended
+    settings. Runs in a worker process."""
+    raw = scan(filepath)
+    filtered = scan(filepath, BPFilter())
+    return {'duration': raw.duration, 'channels': raw.channels,
+            'frame_rate': raw.frame_rate, 'sample_width': raw.sample_width,
+            'raw': summarize(raw), 'filtered': summarize(filtered),
+            'recommended': {'THRESHOLD': int(raw.percentile(50)),
+                            'LEVEL1': int(raw.percentile(25)),
+                            'LEVEL2': int(raw.percentile(75)),
+                            'LEVEL3': int(raw.percentile(90)),
+                            'FILTERED_LEVEL1': int(filtered.percentile(25)),
+                            'FILTERED_LEVEL2': int(filtered.percentile(75)),
+                            'FILTERED_LEVEL3': int(filtered.percentile(90))}}
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache.setdefault('files', {})      # absolute path -> size, mtime and hash
+    cache.setdefault('results', {})    # "hash params" -> analyze_file result
+    return cache
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+
+def cache_key(cache, filepath):
+    """Content hash plus analysis parameters; the hash is reused while the
+    file's size and mtime are unchanged"""
+    path = os.path.abspath(filepath)
+    st = os.stat(path)
+    known = cache['files'].get(path)
+    if known and (known['size'], known['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+        digest = known['hash']
+    else:
+        digest = file_hash(path)
+        cache['files'][path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest}
+    return f"{digest} v{CACHE_VERSION} env{ENVELOPE_SECONDS} pts{PLOT_POINTS}"
+
+def save_envelope_plot(filepath, result):
+    """Saves the cached envelopes of a batch result next to the file"""
+    plt.figure(figsize=(12, 8))
+    for idx, variant in enumerate(('raw', 'filtered')):
+        data = result[variant]
+        plt.subplot(2, 1, idx + 1)
+        times = [i * data['bucket'] / result['frame_rate'] for i in range(len(data['env_max']))]
+        plt.fill_between(times, data['env_min'], data['env_max'], linewidth=0.5)
+        for p, color in (('p25', 'g'), ('p50', 'y'), ('p75', 'orange'), ('p90', 'r')):
+            plt.axhline(y=data[p], color=color, linestyle='--',
+                        label=f"{p[1:]}% ({int(data[p])})")
+        plt.title('Volume Envelope' + (' (filtered)' if variant == 'filtered' else ''))
+        plt.xlabel('Time (s)')
+        plt.ylabel('Volume')
+        plt.legend()
+        plt.grid(True)
+    plt.tight_layout()
+    plt.savefig(f"{os.path.splitext(filepath)[0]}_analysis.png")
+    plt.close()
+
+def print_summary(results):
+    """One row per file plus the library-wide median of each setting"""
+    columns = ('THRESHOLD', 'LEVEL1', 'LEVEL2', 'LEVEL3',
+               'FILTERED_LEVEL1', 'FILTERED_LEVEL2', 'FILTERED_LEVEL3')
+    headers = ('THRESH', 'L1', 'L2', 'L3', 'FL1', 'FL2', 'FL3')
+    width = max([len('Library (median)')] + [len(os.path.basename(f)) for f in results])
+    print(f"\n{'File':<{width}} {'Secs':>7} {'Max':>6} {'Avg':>7} "
+          + ' '.join(f"{h:>6}" for h in headers))
+    for filepath, result in results.items():
+        print(f"{os.path.basename(filepath):<{width}} {result['duration']:7.1f} "
+              f"{int(result['raw']['max']):6d} {result['raw']['avg']:7.1f} "
+              + ' '.join(f"{result['recommended'][c]:6d}" for c in columns))
+    if results:
+        medians = [int(statistics.median(r['recommended'][c] for r in results.values()))
+                   for c in columns]
+        print(f"{'Library (median)':<{width}} {'':>7} {'':>6} {'':>7} "
+              + ' '.join(f"{m:6d}" for m in medians))
+
+def analyze_all(files, workers=None, plots=False, cache_file=CACHE_FILE):
+    """Analyzes files in a process pool, reusing cached results"""
+    cache = load_cache(cache_file)
+    keys = {}
+    for filepath in files:
+        try:
+            keys[filepath] = cache_key(cache, filepath)
+        except OSError as e:
+            print(f"Error reading {filepath}: {e}")
+    todo = [f for f, key in keys.items() if key not in cache['results']]
+    print(f"{len(keys) - len(todo)} of {len(keys)} files already analyzed; analyzing {len(todo)}")
+    try:
+        if todo:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(analyze_file, f): f for f in todo}
+                for done, future in enumerate(as_completed(futures), 1):
+                    filepath = futures[future]
+                    try:
+                        cache['results'][keys[filepath]] = future.result()
+                        print(f"[{done}/{len(todo)}] {filepath}")
+                    except Exception as e:
+                        print(f"[{done}/{len(todo)}] {filepath}: error analyzing file: {e}")
+    finally:
+        save_cache(cache_file, cache)   # keep whatever finished, even if interrupted
+
+    results = {f: cache['results'][key] for f, key in keys.items() if key in cache['results']}
+    print_summary(results)
+    if plots:
+        for filepath, result in results.items():
+            save_envelope_plot(filepath, result)
+        print(f"\nSaved {len(results)} analysis images next to the audio files")
+
 def main():
     parser = argparse.ArgumentParser(description='Analyze audio files for Chatter Pi')
     parser.add_argument('filename', help='Audio file to analyze', nargs='?')
@@ -136,23 +243,25 @@ def main():
                         help='Apply bandpass filter before analysis')
     parser.add_argument('-a', '--all', action='store_true',
                         help='Analyze all audio files in vocals and ambient directories')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Worker processes for --all (default: one per CPU)')
+    parser.add_argument('--plots', action='store_true',
+                        help='With --all, save an envelope image for every file')
+    parser.add_argument('--cache', default=CACHE_FILE,
+                        help=f'Analysis cache for --all (default {CACHE_FILE})')
     
     args = parser.parse_args()
     
     if args.all:
         # Analyze all audio files in vocals and ambient directories
-        found_files = False
+        files = []
         for directory in ['../src/vocals', '../src/ambient']:
             if os.path.exists(directory):
-                files = [f for f in os.listdir(directory) if f.endswith('.wav')]
-                if files:
-                    found_files = True
-                    print(f"\nAnalyzing files in {directory} directory:")
-                    for file in files:
-                        filepath = os.path.join(directory, file)
-                        analyze_audio(filepath, args.filtered)
-        
-        if not found_files:
+                files += [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+                          if f.endswith('.wav')]
+        if files:
+            analyze_all(files, args.jobs, args.plots, args.cache)
+        else:
             print("No .wav files found in src/vocals/ or src/ambient/ directories.")
             print("Please create these directories and add .wav files to them.")
             print("\nExample directory structure:")
@@ -7,13 +7,13 @@ This utility analyzes audio files to help with configuring
 threshold levels for jaw movement. This version does not require scipy.
 """
 
-import wave
-import numpy as np
 import matplotlib.pyplot as plt
 import argparse
 import os
 import sys
 
+from audio_stats import scan
+
 def analyze_audio(filename):
     """Analyze an audio file and display statistics and visualization"""
     if not os.path.exists(filename):
@@ -21,37 +21,20 @@ def analyze_audio(filename):
         return
     
     try:
-        # Open the wave file
-        wf = wave.open(filename, 'rb')
-        
-        # Get basic info
-        channels = wf.getnchannels()
-        sample_width = wf.getsampwidth()
-        frame_rate = wf.getframerate()
-        n_frames = wf.getnframes()
-        duration = n_frames / frame_rate
-        
-        # Read all frames
-        frames = wf.readframes(n_frames)
-        wf.close()
-        
-        # Convert to numpy array
-        samples = np.frombuffer(frames, dtype=np.int16)
-        
-        # If stereo, use right channel for analysis (same as in audio.py)
-        if channels == 2:
-            samples = samples[1::2]
-        
-        # Calculate statistics
-        abs_samples = np.abs(samples)
-        max_volume = np.max(abs_samples)
-        avg_volume = np.mean(abs_samples)
-        
-        # Calculate percentiles for threshold recommendations
-        p25 = np.percentile(abs_samples, 25)
-        p50 = np.percentile(abs_samples, 50)
-        p75 = np.percentile(abs_samples, 75)
-        p90 = np.percentile(abs_samples, 90)
+        # Read the file in chunks, collecting statistics as we go
+        stats = scan(filename)
+        channels = stats.channels
+        sample_width = stats.sample_width
+        frame_rate = stats.frame_rate
+        duration = stats.duration
+        max_volume = stats.max_volume
+        avg_volume = stats.avg_volume
+
+        # Percentiles for threshold recommendations, from the histogram
+        p25 = stats.percentile(25)
+        p50 = stats.percentile(50)
+        p75 = stats.percentile(75)
+        p90 = stats.percentile(90)
         
         # Print analysis
         print(f"\nAudio Analysis for: {filename}")
@@ -73,25 +56,20 @@ def analyze_audio(filename):
         # Create visualization
         plt.figure(figsize=(12, 8))
         
-        # Plot waveform
+        # Plot waveform (min/max of each plotted point)
         plt.subplot(2, 1, 1)
-        plt.plot(np.arange(len(samples)) / frame_rate, samples)
+        plt.fill_between(stats.times(len(stats.wave_min)), stats.wave_min, stats.wave_max,
+                         linewidth=0.5)
         plt.title('Waveform')
         plt.xlabel('Time (s)')
         plt.ylabel('Amplitude')
         plt.grid(True)
         
-        # Plot volume envelope
+        # Plot volume envelope (50ms rolling mean, min/max of each plotted point)
         plt.subplot(2, 1, 2)
-        
-        # Calculate envelope (using rolling window)
-        window_size = int(frame_rate * 0.05)  # 50ms window
-        if window_size > 0:
-            envelope = np.zeros(len(abs_samples) - window_size + 1)
-            for i in range(len(envelope)):
-                envelope[i] = np.mean(abs_samples[i:i+window_size])
-            
-            plt.plot(np.arange(len(envelope)) / frame_rate, envelope)
+        if len(stats.env_max):
+            plt.fill_between(stats.times(len(stats.env_max)), stats.env_min, stats.env_max,
+                             linewidth=0.5)
             
             # Add threshold lines
             plt.axhline(y=p25, color='g', linestyle='--', label=f'25% ({int(p25)})')
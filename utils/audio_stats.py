@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming audio statistics for the Chatter Pi analyzers
+
+A file is read in fixed-size chunks and never held in memory as a whole:
+|sample| values go into an exact 65536-bin histogram (all percentiles come
+from it), alongside a running max and mean, and the waveform and 50 ms
+volume envelope are reduced to min/max pairs for plotting. Memory use is the
+same for a 5 second vocal and an hour-long ambient bed.
+"""
+
+import wave
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from jawtrack import moving_average
+
+HIST_BINS = 65536           # one bin per integer volume; larger filtered values go in the last
+CHUNK_FRAMES = 65536
+PLOT_POINTS = 2000          # min/max pairs kept for each plot
+ENVELOPE_SECONDS = 0.05
+
+class MinMaxDecimator:
+    """Min and max of each run of `bucket` consecutive values, fed in chunks"""
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.carry = np.zeros(0)
+        self.mins = []
+        self.maxs = []
+
+    def add(self, values):
+        values = np.concatenate((self.carry, values))
+        n = len(values) // self.bucket * self.bucket
+        if n:
+            blocks = values[:n].reshape(-1, self.bucket)
+            self.mins.append(blocks.min(axis=1))
+            self.maxs.append(blocks.max(axis=1))
+        self.carry = values[n:]
+
+    def result(self):
+        if len(self.carry):
+            self.mins.append(self.carry.min(keepdims=True))
+            self.maxs.append(self.carry.max(keepdims=True))
+            self.carry = np.zeros(0)
+        if not self.mins:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(self.mins), np.concatenate(self.maxs)
+
+class AudioStats:
+    """What scan() found: file info, volume statistics and plot envelopes"""
+    def __init__(self, filename, channels, sample_width, frame_rate, n_frames):
+        self.filename = filename
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self.n_frames = n_frames
+        self.duration = n_frames / frame_rate
+        self.histogram = np.zeros(HIST_BINS, dtype=np.int64)
+        self.count = 0
+        self.max_volume = 0
+        self.avg_volume = 0.0
+        self.bucket = 1             # samples per plot point
+        self.wave_min = self.wave_max = np.zeros(0)
+        self.env_min = self.env_max = np.zeros(0)
+        self._cumulative = None
+
+    def percentile(self, p):
+        """Same as np.percentile(abs_samples, p) (linear interpolation), but from
+        the histogram; filtered values are counted by their integer part"""
+        if self.count == 0:
+            return 0.0
+        if self._cumulative is None:
+            self._cumulative = np.cumsum(self.histogram)
+        rank = p / 100 * (self.count - 1)
+        lo = int(np.floor(rank))
+        hi = min(lo + 1, self.count - 1)
+        v_lo, v_hi = np.searchsorted(self._cumulative, [lo, hi], side='right')
+        return v_lo + (v_hi - v_lo) * (rank - lo)
+
+    def times(self, n):
+        """Plot times (s) of n decimated points"""
+        return np.arange(n) * self.bucket / self.frame_rate
+
+def scan(filename, bp=None, chunk_frames=CHUNK_FRAMES, plot_points=PLOT_POINTS):
+    """Reads a 16-bit wave file chunk by chunk and returns its AudioStats. As
+    in audio.py, stereo files are analyzed on the right channel. With bp (a
+    BPFilter) the filtered signal is analyzed instead."""
+    with wave.open(filename, 'rb') as wf:
+        channels = wf.getnchannels()
+        stats = AudioStats(filename, channels, wf.getsampwidth(), wf.getframerate(),
+                           wf.getnframes())
+        window_size = int(stats.frame_rate * ENVELOPE_SECONDS)
+        stats.bucket = max(1, -(-stats.n_frames // plot_points))
+        waveform = MinMaxDecimator(stats.bucket)
+        envelope = MinMaxDecimator(stats.bucket)
+        tail = np.zeros(0)      # last window_size - 1 values, for the envelope across chunks
+        total = 0.0
+        if bp is not None:
+            bp.reset()
+        while True:
+            data = wf.readframes(chunk_frames)
+            if not data:
+                break
+            samples = np.frombuffer(data, dtype=np.int16)
+            if channels == 2:
+                samples = samples[1::2]
+            if bp is not None:
+                samples = bp.filter_chunk(samples)
+                levels = np.abs(samples)
+            else:
+                levels = np.abs(samples.astype(np.int32))
+            stats.histogram += np.bincount(np.minimum(levels, HIST_BINS - 1).astype(np.int64),
+                                           minlength=HIST_BINS)
+            stats.count += len(levels)
+            stats.max_volume = max(stats.max_volume, levels.max())
+            total += float(np.sum(levels))
+            waveform.add(samples)
+            if window_size > 0:
+                window = np.concatenate((tail, levels))
+                envelope.add(moving_average(window, window_size))
+                tail = window[-(window_size - 1):] if window_size > 1 else np.zeros(0)
+    stats.avg_volume = total / stats.count if stats.count else 0.0
+    stats.wave_min, stats.wave_max = waveform.result()
+    stats.env_min, stats.env_max = envelope.result()
+    return stats
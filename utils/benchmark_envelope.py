@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Envelope Benchmark for Chatter Pi
+
+Times the 50 ms volume envelope used by the analyzers: the old loop, which
+averages one window per sample, against jawtrack.moving_average, which uses
+a cumulative sum. The loop is timed on the first --loop-seconds of the file
+and scaled up to the whole file, since running it in full takes minutes.
+"""
+
+import wave
+import time
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from jawtrack import moving_average
+
+DEFAULT_FILE = os.path.join(os.path.dirname(__file__), '..', 'src', 'vocals', 'v01.wav')
+
+def loop_envelope(abs_samples, window_size):
+    """The analyzers' original envelope: one np.mean per output sample"""
+    envelope = np.zeros(len(abs_samples) - window_size + 1)
+    for i in range(len(envelope)):
+        envelope[i] = np.mean(abs_samples[i:i+window_size])
+    return envelope
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the analyzers\' volume envelope')
+    parser.add_argument('filename', nargs='?', default=DEFAULT_FILE,
+                        help='Audio file to use (default src/vocals/v01.wav)')
+    parser.add_argument('--loop-seconds', type=float, default=5.0,
+                        help='Audio to run the old loop on (default 5)')
+    args = parser.parse_args()
+
+    with wave.open(args.filename, 'rb') as wf:
+        channels = wf.getnchannels()
+        frame_rate = wf.getframerate()
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+    if channels == 2:
+        samples = samples[1::2]
+    abs_samples = np.abs(samples)
+    window_size = int(frame_rate * 0.05)
+    print(f"{args.filename}: {len(samples) / frame_rate:.1f} s at {frame_rate} Hz, "
+          f"{window_size}-sample window")
+
+    start = time.perf_counter()
+    envelope = moving_average(abs_samples, window_size)
+    vectorized = time.perf_counter() - start
+
+    part = abs_samples[:int(args.loop_seconds * frame_rate) + window_size - 1]
+    start = time.perf_counter()
+    expected = loop_envelope(part, window_size)
+    looped = (time.perf_counter() - start) * len(envelope) / max(len(expected), 1)
+
+    if not np.allclose(envelope[:len(expected)], expected):
+        print("Results differ!")
+        sys.exit(1)
+    print(f"Loop:       {looped:8.2f} s (estimated from {args.loop_seconds:g} s of audio)")
+    print(f"Vectorized: {vectorized:8.4f} s")
+    print(f"Speedup:    {looped / vectorized:8.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Threshold Calibration for Chatter Pi
+
+Finds THRESHOLD, LEVEL1-3 and FILTERED_LEVEL1-3 by simulating the jaw over
+the whole vocal library, instead of reading them off sample percentiles.
+Each file is cut into BUFFER_SIZE chunks and reduced to the volumes
+AUDIO.get_avg sees (jawtrack.block_volumes: right channel, chunk mean,
+bandpass filtered for STYLE 2), keeping only the chunks that get past the
+50-updates-per-second limit. Candidate threshold sets are then scored on:
+
+  open       -- how far the share of time with the jaw open is from --open-ratio
+  dwell      -- share of time spent in positions held for less than --min-dwell
+  reversals  -- share of jaw updates where the jaw changes direction
+  balance    -- (multi-level styles) how unevenly the open positions are used
+
+and the best set is written to [CONTROLLER] in config.ini (unless --dry-run)
+and pushed to ChatterPi if it is running. With --per-track, each file is
+calibrated on its own instead and the results are saved as profiles in the
+track index, which ChatterPi applies whenever that vocal plays.
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, SRC_DIR)
+import config as c
+import liveparams
+import trackindex
+from jawtrack import block_volumes
+
+UPDATE_INTERVAL = 0.02      # audio.py moves the jaw at most this often
+GRID_POINTS = 48            # candidate values for each threshold
+TRACK_GRID_POINTS = 24      # the same for --per-track, where each search is on its own
+OBJECTIVES = ('open', 'dwell', 'reversals', 'balance')
+STYLES = (('STYLE 0 (single threshold)', ['THRESHOLD'], 'raw'),
+          ('STYLE 1 (multi-level)', ['LEVEL1', 'LEVEL2', 'LEVEL3'], 'raw'),
+          ('STYLE 2 (filtered multi-level)',
+           ['FILTERED_LEVEL1', 'FILTERED_LEVEL2', 'FILTERED_LEVEL3'], 'filtered'))
+
+def file_volumes(path, block_frames):
+    """Unfiltered (STYLE 0 and 1) and filtered (STYLE 2) volumes of the chunks
+    that update the jaw, and the seconds between updates. Runs in a worker
+    process."""
+    from bandpassFilter import BPFilter
+    with wave.open(path, 'rb') as wf:
+        channels = wf.getnchannels()
+        rate = wf.getframerate()
+        if wf.getsampwidth() != 2:
+            raise ValueError("only 16-bit audio is supported")
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype='<i2')
+    # callbacks come every block_frames / rate seconds; the jaw follows the
+    # first one more than UPDATE_INTERVAL after the last update
+    chunk_seconds = block_frames / rate
+    step = int(UPDATE_INTERVAL // chunk_seconds) + 1
+    raw = block_volumes(samples, channels, block_frames)[::step]
+    filtered = block_volumes(samples, channels, block_frames, BPFilter())[::step]
+    return raw.astype(np.int64), filtered.astype(np.int64), chunk_seconds * step
+
+def evaluate(pos, tracks, dt, levels, min_dwell):
+    """Objective values for a sequence of jaw positions (0 = closed, levels =
+    fully open). tracks gives each update's file, dt its duration."""
+    total = dt.sum()
+    changed = np.diff(pos) != 0
+    same_track = tracks[1:] == tracks[:-1]
+
+    starts = np.flatnonzero(np.concatenate(([True], changed | ~same_track)))
+    runs = np.add.reduceat(dt, starts)
+    dwell = runs[runs < min_dwell].sum() / total
+
+    moves = np.flatnonzero(changed & same_track)
+    direction = np.sign(np.diff(pos)[moves])
+    reversals = np.count_nonzero((direction[1:] != direction[:-1])
+                                 & (tracks[moves[1:]] == tracks[moves[:-1]])) / len(pos)
+
+    occupancy = np.bincount(pos, weights=dt, minlength=levels + 1)
+    open_time = occupancy[1:].sum()
+    balance = 0.0
+    if levels > 1 and open_time:
+        balance = np.abs(occupancy[1:] / open_time - 1 / levels).sum() / 2
+    return {'open': open_time / total, 'dwell': dwell,
+            'reversals': reversals, 'balance': balance}
+
+def score(metrics, settings):
+    """Weighted cost of a threshold set; lower is better"""
+    weights = settings['weights']
+    return (weights['open'] * abs(metrics['open'] - settings['open_ratio'])
+            + weights['dwell'] * metrics['dwell']
+            + weights['reversals'] * metrics['reversals']
+            + weights['balance'] * metrics['balance'])
+
+def search_from(first, bins, n_grid, levels, tracks, dt, settings):
+    """Best threshold set (as grid indexes) whose lowest threshold is grid
+    index `first`. Runs in a worker process."""
+    above = [(bins > i).astype(np.int8) for i in range(n_grid)]
+    best = None
+    for rest in itertools.combinations(range(first + 1, n_grid), levels - 1):
+        combo = (first,) + rest
+        pos = sum(above[i] for i in combo)
+        metrics = evaluate(pos, tracks, dt, levels, settings['min_dwell'])
+        cost = score(metrics, settings)
+        if best is None or cost < best[0]:
+            best = (cost, combo, metrics)
+    return best
+
+def calibrate(volumes, tracks, dt, levels, settings, pool=None, grid_points=GRID_POINTS):
+    """Searches the threshold sets for one style, in the pool's processes if
+    one is given. Thresholds are drawn from a grid of quantiles of all the
+    volumes. Returns (thresholds, metrics)."""
+    if len(volumes) == 0:
+        raise ValueError("no audio to calibrate from")
+    grid = np.unique(np.percentile(volumes, np.linspace(2, 98, grid_points)).astype(np.int64))
+    if len(grid) < levels:
+        raise ValueError("the vocals are too quiet or too uniform to calibrate")
+    # volume > grid[i] exactly when bins > i
+    bins = np.searchsorted(grid, volumes, side='left')
+    n_grid = len(grid)
+    firsts = range(n_grid - levels + 1)
+    if pool is None:
+        results = [search_from(first, bins, n_grid, levels, tracks, dt, settings)
+                   for first in firsts]
+    else:
+        futures = [pool.submit(search_from, first, bins, n_grid, levels, tracks, dt, settings)
+                   for first in firsts]
+        results = [f.result() for f in futures]
+    cost, combo, metrics = min(results, key=lambda best: best[0])
+    return [int(grid[i]) for i in combo], metrics
+
+def calibrate_track(path, block_frames, settings, style=None, loudness_target=None):
+    """A track index profile for one file: its own thresholds for every
+    style, plus STYLE if given and, with loudness_target, the GAIN (dB) that
+    brings it to that loudness without clipping. Runs in a worker process."""
+    raw, filtered, seconds = file_volumes(path, block_frames)
+    volumes = {'raw': raw, 'filtered': filtered}
+    tracks = np.zeros(len(raw), dtype=np.int64)
+    dt = np.full(len(raw), seconds)
+    profile = {}
+    for label, names, variant in STYLES:
+        try:
+            found, _ = calibrate(volumes[variant], tracks, dt, len(names), settings,
+                                 grid_points=TRACK_GRID_POINTS)
+        except ValueError:
+            continue    # too quiet; the global values apply
+        profile.update(zip(names, found))
+    if style is not None:
+        profile['STYLE'] = style
+    if loudness_target is not None:
+        from maxVol import measure_loudness
+        loudness, block_peaks, _ = measure_loudness(path)
+        peak = np.max(block_peaks) if len(block_peaks) else 0
+        if loudness is not None and peak > 0:
+            headroom = -20 * np.log10(peak)
+            profile['GAIN'] = round(float(min(loudness_target - loudness, headroom)), 1)
+    return profile
+
+def positions(volumes, thresholds):
+    """Jaw positions for fixed thresholds, as target_for_volume picks them"""
+    return sum((volumes > t).astype(np.int8) for t in thresholds)
+
+def write_controller(config_path, values):
+    """Updates [CONTROLLER] in config.ini line by line, so comments, key case
+    and everything else in the file stay as they are. Settings the section
+    doesn't have yet are added at its end."""
+    with open(config_path) as f:
+        lines = f.readlines()
+    remaining = dict(values)
+    section = None
+    end = None      # where the [CONTROLLER] section's last setting ends
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped.startswith('[') and stripped.endswith(']'):
+            section = stripped[1:-1].strip().upper()
+            if section == 'CONTROLLER':
+                end = i + 1
+            continue
+        if section != 'CONTROLLER' or not stripped or stripped[0] in '#;':
+            continue
+        end = i + 1
+        key, sep, _ = line.partition('=')
+        name = key.strip().upper()
+        if sep and name in remaining:
+            lines[i] = f"{key.rstrip()} = {remaining.pop(name)}\n"
+    if end is None:
+        raise ValueError(f"{config_path} has no [CONTROLLER] section")
+    if lines[end - 1] and not lines[end - 1].endswith('\n'):
+        lines[end - 1] += '\n'
+    lines[end:end] = [f"{name} = {value}\n" for name, value in remaining.items()]
+    with open(config_path + '.tmp', 'w') as f:
+        f.writelines(lines)
+    os.replace(config_path + '.tmp', config_path)
+
+def print_result(label, names, current, found, current_metrics, metrics):
+    print(f"\n{label}")
+    width = max(len(n) for n in names + list(OBJECTIVES))
+    print(f"  {'':<{width}} {'current':>9} {'calibrated':>11}")
+    for name, old, new in zip(names, current, found):
+        print(f"  {name:<{width}} {old:9d} {new:11d}")
+    for objective in OBJECTIVES:
+        print(f"  {objective:<{width}} {current_metrics[objective]:9.3f} {metrics[objective]:11.3f}")
+
+def calibrate_tracks(files, args, settings):
+    """--per-track: a profile for every file, saved to the track index"""
+    index = trackindex.TrackIndex.load(args.index)
+    root = os.path.dirname(os.path.abspath(args.index))
+    loudness_target = c.LOUDNESS_TARGET if args.gain else None
+    saved = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(calibrate_track, f, c.BUFFER_SIZE, settings, args.style,
+                               loudness_target) for f in files]
+        for filepath, future in zip(files, futures):
+            try:
+                profile = future.result()
+            except (OSError, EOFError, wave.Error, ValueError) as e:
+                print(f"Skipping {filepath}: {e}")
+                continue
+            key = trackindex.track_key(os.path.abspath(filepath), root)
+            index.set_profile(key, profile)
+            saved += 1
+            print(f"{key}: " + ', '.join(f"{k} = {v}" for k, v in profile.items()))
+    if args.dry_run:
+        return
+    if not saved:
+        print("\nNo profiles saved")
+        return
+    index.save()
+    print(f"\nSaved {saved} of {len(files)} profiles to {args.index}; they apply from ChatterPi's next start")
+
+def parse_weights(text):
+    values = [float(v) for v in text.split(',')]
+    if len(values) != len(OBJECTIVES):
+        raise argparse.ArgumentTypeError(f"expected {len(OBJECTIVES)} comma-separated weights")
+    return dict(zip(OBJECTIVES, values))
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate jaw thresholds by simulating the vocals')
+    parser.add_argument('paths', nargs='*', default=[os.path.join(SRC_DIR, 'vocals')],
+                        help='Vocal files or directories (default src/vocals)')
+    parser.add_argument('--config', default=os.path.join(SRC_DIR, 'config.ini'),
+                        help='config.ini to read BUFFER_SIZE from and write to')
+    parser.add_argument('--open-ratio', type=float, default=0.4,
+                        help='Share of speaking time the jaw should be open (default 0.4)')
+    parser.add_argument('--min-dwell', type=float, default=0.08,
+                        help='Shortest time a position should be held, seconds (default 0.08)')
+    parser.add_argument('--weights', type=parse_weights, default=parse_weights('1,1,1,0.5'),
+                        help='Weights of the open, dwell, reversals and balance objectives '
+                             '(default 1,1,1,0.5)')
+    parser.add_argument('--per-track', action='store_true',
+                        help='Calibrate each file on its own and save profiles to the track index')
+    parser.add_argument('--index', default=os.path.join(SRC_DIR, trackindex.INDEX_FILE),
+                        help='Track index for --per-track (default src/trackindex.json)')
+    parser.add_argument('--style', type=int, choices=(0, 1, 2), default=None,
+                        help='With --per-track, the STYLE to save in each profile')
+    parser.add_argument('--gain', action='store_true',
+                        help='With --per-track, save a GAIN that brings each file to LOUDNESS_TARGET')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print the calibrated values without saving them')
+    args = parser.parse_args()
+
+    c.update(args.config)
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.wav')]
+        else:
+            files.append(path)
+    if not files:
+        print("No .wav files to calibrate from")
+        sys.exit(1)
+    settings = {'open_ratio': args.open_ratio, 'min_dwell': args.min_dwell,
+                'weights': args.weights}
+
+    if args.per_track:
+        calibrate_tracks(files, args, settings)
+        return
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        raw, filtered, tracks, dt = [], [], [], []
+        futures = [pool.submit(file_volumes, f, c.BUFFER_SIZE) for f in files]
+        for index, (filepath, future) in enumerate(zip(files, futures)):
+            try:
+                file_raw, file_filtered, seconds = future.result()
+            except (OSError, EOFError, wave.Error, ValueError) as e:
+                print(f"Skipping {filepath}: {e}")
+                continue
+            raw.append(file_raw)
+            filtered.append(file_filtered)
+            tracks.append(np.full(len(file_raw), index))
+            dt.append(np.full(len(file_raw), seconds))
+        if not raw:
+            print("None of the files could be read")
+            sys.exit(1)
+        raw, filtered = np.concatenate(raw), np.concatenate(filtered)
+        tracks, dt = np.concatenate(tracks), np.concatenate(dt)
+        print(f"Simulating {len(raw)} jaw updates ({dt.sum():.0f} s) from {len(files)} files "
+              f"at BUFFER_SIZE = {c.BUFFER_SIZE}")
+
+        volumes_by_variant = {'raw': raw, 'filtered': filtered}
+        calibrated = {}
+        for label, names, variant in STYLES:
+            volumes = volumes_by_variant[variant]
+            try:
+                found, metrics = calibrate(volumes, tracks, dt, len(names), settings, pool)
+            except ValueError as e:
+                print(f"\n{label}: {e}")
+                continue
+            current = [getattr(c, name) for name in names]
+            current_metrics = evaluate(positions(volumes, current), tracks, dt,
+                                       len(names), args.min_dwell)
+            print_result(label, names, current, found, current_metrics, metrics)
+            calibrated.update(zip(names, found))
+
+    if args.dry_run or not calibrated:
+        return
+    write_controller(args.config, calibrated)
+    print(f"\nSaved to [CONTROLLER] in {args.config}")
+    if liveparams.push(c.CONTROL_SOCKET, calibrated):
+        print("Sent to running ChatterPi")
+
+if __name__ == "__main__":
+    main()
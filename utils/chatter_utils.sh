@@ -14,6 +14,7 @@ show_help() {
     echo "Available commands:"
     echo "  analyze [file]     - Analyze audio file(s)"
     echo "  analyze-basic      - Analyze audio without scipy"
+    echo "  calibrate          - Calibrate jaw thresholds from the vocals"
     echo "  test-servo         - Test servo movement"
     echo "  backup             - Create a backup"
     echo "  restore [file]     - Restore from backup"
@@ -25,6 +26,7 @@ show_help() {
     echo "Examples:"
     echo "  $0 analyze ../src/vocals/v01.wav"
     echo "  $0 analyze --all"
+    echo "  $0 calibrate --dry-run"
     echo "  $0 test-servo --mode steps"
     echo "  $0 backup"
     echo "  $0 restore backup_20250226_123456.zip"
@@ -54,6 +56,10 @@ case "$1" in
             python3 "$SCRIPT_DIR/analyze_audio_basic.py" "$@"
         fi
         ;;
+    calibrate)
+        shift
+        python3 "$SCRIPT_DIR/calibrate.py" "$@"
+        ;;
     test-servo)
         shift
         python3 "$SCRIPT_DIR/test_servo.py" "$@"
@@ -1,96 +1,894 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Daemon process that watches a directory for .wav files and processes them through main.py
+Daemon process that watches a directory for .wav files and plays them through
+the Chatter Pi audio engine.
+
+Files move through a pipeline: arrival detection, validation and format
+normalization, jaw-track precomputation in a process pool, and playback one
+at a time. Up to --lookahead files are prepared while another one plays.
+
+Files are played in-process by one long-lived AUDIO instance, so PortAudio,
+pigpio and the numpy/scipy imports are only paid for once. If in-process
+playback ever fails, the daemon switches to running main.py in a subprocess
+for each file.
+
+With --stream, playback starts while a file is still being written (for
+example by a text-to-speech engine), once its header and STREAM_START_SECONDS
+of audio are on disk; the rest is followed as it is appended.
+
+Several directories can be watched, each with a priority. Files waiting to
+play are ordered by directory priority and then age (or by age alone with
+--order mtime); files already present at startup are scanned in the
+background. Failed files are retried with backoff and then moved to a
+dead-letter directory.
+
+Per-file stage timings, counters and latency histograms can be exported in
+Prometheus text format (--metrics-file, --metrics-port) and recorded as JSON
+lines (--events-log).
+
+Files are identified by a hash of their contents. The prepared audio and jaw
+track of recent files are kept in an LRU cache (--cache-mb), so a phrase that
+is sent again skips preparation entirely.
 """
 
 import time
 import os
 import sys
+import wave
+import queue
+import json
+import shutil
 import logging
+import argparse
+import tempfile
+import itertools
+import threading
 import subprocess
-import configparser
+from collections import OrderedDict, deque
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+STREAM_HEADER_TIMEOUT = 5.0     # seconds a new file may take to get its WAV header
+HEADER_RECHECK = 0.1    # seconds before a stream still waiting for its header is looked at again
+STALE_PENDING = 60.0    # seconds an unfinished file may sit unchanged before it is validated anyway
+
 # Setup logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
+class WavJob:
+    """A file on its way through the pipeline, with a timestamp per stage"""
+    __slots__ = ('path', 'priority', 'mtime', 'attempts', 'play_path', 'jaw_future',
+                 'jaw_track', 'stream', 'digest', 'asset', 'cache_hit', 'mode',
+                 'detected', 'validated', 'prepared', 'started', 'first_audio', 'finished')
+
+    def __init__(self, path, priority=0, mtime=None):
+        self.path = path
+        self.priority = priority
+        if mtime is None:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                mtime = time.time()
+        self.mtime = mtime
+        self.attempts = 0
+        self.play_path = path
+        self.jaw_future = None
+        self.jaw_track = None
+        self.stream = None      # wavstream.GrowingWavReader when streaming
+        self.digest = None      # content hash
+        self.asset = None       # PreparedAsset, once the file is prepared
+        self.cache_hit = False
+        self.mode = None        # how it was played
+        self.first_audio = None     # detection to first audio, seconds
+        self.detected = time.monotonic()
+        self.validated = self.prepared = self.started = self.finished = None
+
+class PreparedAsset:
+    """A file's 16-bit PCM and jaw track, ready to play from memory"""
+    __slots__ = ('pcm', 'channels', 'rate', 'jaw_track', 'duration')
+
+    def __init__(self, pcm, channels, rate, jaw_track):
+        self.pcm = pcm
+        self.channels = channels
+        self.rate = rate
+        self.jaw_track = jaw_track
+        self.duration = len(pcm) / (2 * channels * rate)
+
+class AssetCache:
+    """LRU store of PreparedAssets keyed by content hash, bounded in bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.assets = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, digest):
+        with self.lock:
+            asset = self.assets.get(digest)
+            if asset is None:
+                self.misses += 1
+                return None
+            self.assets.move_to_end(digest)
+            self.hits += 1
+            return asset
+
+    def put(self, digest, asset):
+        size = len(asset.pcm)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.assets.pop(digest, None)
+            if old is not None:
+                self.bytes -= len(old.pcm)
+            self.assets[digest] = asset
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.assets.popitem(last=False)
+                self.bytes -= len(evicted.pcm)
+
+    def report(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            ratio = self.hits / lookups if lookups else 0.0
+            return (f"{self.hits}/{lookups} hits ({ratio:.0%}), {len(self.assets)} files, "
+                    f"{self.bytes / 2**20:.1f} of {self.max_bytes / 2**20:.0f} MB")
+
+class Metrics:
+    """
+    Counters and latency histograms for the pipeline. Each stage is timed
+    from the moment a file was detected: ready (prepared), start (playback
+    started), first_audio and done.
+    """
+    STAGES = ('ready', 'start', 'first_audio', 'done')
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    COUNTERS = {'files': 'Files played',
+                'failures': 'Failed attempts to prepare or play a file',
+                'retries': 'Retries scheduled',
+                'dead_letter': 'Files moved to the dead-letter directory'}
+
+    def __init__(self, events_log=None, window=500):
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.buckets = {stage: [0] * len(self.BUCKETS) for stage in self.STAGES}
+        self.sums = dict.fromkeys(self.STAGES, 0.0)
+        self.observed = dict.fromkeys(self.STAGES, 0)
+        self.recent = {stage: deque(maxlen=window) for stage in self.STAGES}
+        self.completions = deque()      # monotonic finish times in the last minute
+        self.gauges = lambda: {}        # extra gauges (queue depth, cache), set by the pipeline
+        self.events = open(events_log, 'a') if events_log else None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _observe(self, stage, seconds):
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.buckets[stage][i] += 1
+        self.sums[stage] += seconds
+        self.observed[stage] += 1
+        self.recent[stage].append(seconds)
+
+    def record(self, job, error=None):
+        """Records a finished attempt at a job and appends it to the events log"""
+        stages = {'ready': job.prepared, 'start': job.started, 'done': job.finished}
+        stages = {stage: t - job.detected for stage, t in stages.items() if t is not None}
+        if job.first_audio is not None:
+            stages['first_audio'] = job.first_audio
+        with self.lock:
+            if error is None:
+                self.counts['files'] += 1
+                for stage, seconds in stages.items():
+                    self._observe(stage, seconds)
+                now = time.monotonic()
+                self.completions.append(now)
+                while self.completions[0] < now - 60:
+                    self.completions.popleft()
+            else:
+                self.counts['failures'] += 1
+            if self.events is not None:
+                event = {'time': time.time(), 'file': job.path, 'priority': job.priority,
+                         'attempt': job.attempts + 1, 'mode': job.mode,
+                         'cache_hit': job.cache_hit, 'error': error}
+                event.update({f"{stage}_ms": round(seconds * 1000, 1)
+                              for stage, seconds in stages.items()})
+                try:
+                    self.events.write(json.dumps(event) + '\n')
+                    self.events.flush()
+                except OSError as e:
+                    logging.error(f"Could not append to the events log: {e}")
+
+    def files_per_minute(self):
+        with self.lock:
+            now = time.monotonic()
+            return sum(1 for t in self.completions if t >= now - 60)
+
+    def summary(self):
+        """One line for the log: throughput, failures and first-audio/done percentiles"""
+        def percentiles(stage):
+            values = sorted(self.recent[stage])
+            if not values:
+                return "n/a"
+            p50 = values[len(values) // 2]
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            return f"p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms"
+        rate = self.files_per_minute()
+        with self.lock:
+            return (f"{rate} files/min, {self.counts['failures']} failures; "
+                    f"first audio {percentiles('first_audio')}; done {percentiles('done')}")
+
+    def prometheus(self):
+        """The metrics in Prometheus text exposition format"""
+        lines = []
+        rate = self.files_per_minute()
+        gauges = dict(self.gauges(), files_per_minute=rate)
+        with self.lock:
+            for name, help_text in self.COUNTERS.items():
+                lines += [f"# HELP chatterpi_daemon_{name}_total {help_text}",
+                          f"# TYPE chatterpi_daemon_{name}_total counter",
+                          f"chatterpi_daemon_{name}_total {self.counts[name]}"]
+            for stage in self.STAGES:
+                metric = f"chatterpi_daemon_{stage}_seconds"
+                lines += [f"# HELP {metric} Time from detection to {stage.replace('_', ' ')}",
+                          f"# TYPE {metric} histogram"]
+                for bound, n in zip(self.BUCKETS, self.buckets[stage]):
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {n}')
+                lines += [f'{metric}_bucket{{le="+Inf"}} {self.observed[stage]}',
+                          f"{metric}_sum {self.sums[stage]:.6f}",
+                          f"{metric}_count {self.observed[stage]}"]
+        for name, value in gauges.items():
+            lines += [f"# TYPE chatterpi_daemon_{name} gauge",
+                      f"chatterpi_daemon_{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path):
+        """Writes the Prometheus text to path atomically (e.g. for node_exporter).
+        A failed write (disk full, no permission) is logged, not raised, so it
+        can't stop the daemon; the next export tries again."""
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.error(f"Could not write metrics to {path}: {e}")
+
+    def serve(self, port):
+        """Serves /metrics on localhost"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+        return server
+
+def wav_data_complete(path):
+    """
+    True if the file's RIFF header declares a non-empty data chunk and the file
+    holds all of it. Writers like Python's wave module only fill in the real
+    data size when they close the file.
+    """
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if f.read(12)[8:12] != b'WAVE':
+                return False
+            offset = 12
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                chunk_size = int.from_bytes(header[4:8], 'little')
+                offset += 8
+                if header[:4] == b'data':
+                    return chunk_size > 0 and size >= offset + chunk_size
+                offset += chunk_size + (chunk_size & 1)
+                f.seek(offset)
+    except OSError:
+        return False
+
+def supports_close_events(observer):
+    """Only the inotify observer reports when a writer closes a file"""
+    return type(observer).__name__ == 'InotifyObserver'
+
 class WavFileHandler(FileSystemEventHandler):
     """
-    Handles file system events, specifically for .wav files.
+    Handles file system events, specifically for .wav files, in one watched
+    directory. A file is passed on once it is complete: when it appears
+    already complete (moved in from elsewhere), when its writer closes it,
+    when it is renamed into place (write to a hidden or non-.wav name, then
+    rename), or once its size is stable and its header is complete. The last
+    is polled for even where close events are available, for files whose
+    close isn't seen; one left unchanged for STALE_PENDING seconds is passed
+    on regardless, and fails validation if it is broken.
     """
+    def __init__(self, pipeline, directory, priority=0, close_events=True, poll_interval=0.2):
+        super().__init__()
+        self.pipeline = pipeline
+        self.directory = directory
+        self.priority = priority
+        self.pending = {}       # path -> (created time, last (size, mtime) seen, seen since)
+        self.lock = threading.Lock()
+        # with close events the poll only mops up, so it needn't be quick
+        self.poll_interval = poll_interval if not close_events else max(poll_interval, 1.0)
+        threading.Thread(target=self._poll, daemon=True).start()
+
+    def is_wav(self, path):
+        # files moved into a subdirectory (e.g. the dead-letter one) don't count
+        return (os.path.dirname(path) == self.directory and path.endswith('.wav')
+                and not os.path.basename(path).startswith('.'))
+
+    def track(self, filepath):
+        """Waits for a file that is still being written to be complete"""
+        with self.lock:
+            self.pending.setdefault(filepath, (time.monotonic(), None, None))
+
+    def _complete(self, filepath, how, pending_only=False):
+        with self.lock:
+            entry = self.pending.pop(filepath, None)
+        if entry is None and pending_only:
+            return      # already passed on another way
+        if entry is not None:
+            logging.info(f"WAV file complete ({how}, {(time.monotonic() - entry[0]) * 1000:.0f} ms "
+                         f"after it appeared): {filepath}")
+        else:
+            logging.info(f"WAV file complete ({how}): {filepath}")
+        self.pipeline.submit(filepath, self.priority)
+
     def on_created(self, event):
         if event.is_directory:
             return None
-        
+
         filepath = event.src_path
-        if filepath.endswith('.wav'):
+        if self.is_wav(filepath):
             logging.info(f"New WAV file detected: {filepath}")
-            process_wav_file(filepath)
+            if wav_data_complete(filepath):
+                # moved in from another directory or filesystem: no close follows
+                self._complete(filepath, "moved in")
+                return
+            self.track(filepath)
+            if self.pipeline.streaming:
+                self.pipeline.submit_stream(filepath, self.priority)
+
+    def on_closed(self, event):
+        # closed after writing; only files still being written count, so
+        # readers (including our own playback) don't resubmit a file
+        if not event.is_directory:
+            self._complete(event.src_path, "closed", pending_only=True)
+
+    def on_moved(self, event):
+        if event.is_directory:
+            return None
+        with self.lock:
+            self.pending.pop(event.src_path, None)
+        if self.is_wav(event.dest_path):
+            self._complete(event.dest_path, "renamed")
+
+    def _poll(self):
+        """Fallback: a file is complete when it stops growing and its header checks out"""
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                entries = list(self.pending.items())
+            now = time.monotonic()
+            for filepath, (created, last, since) in entries:
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    with self.lock:
+                        self.pending.pop(filepath, None)
+                    continue
+                seen = (st.st_size, st.st_mtime_ns)
+                if seen != last:
+                    with self.lock:
+                        if filepath in self.pending:
+                            self.pending[filepath] = (created, seen, now)
+                elif wav_data_complete(filepath):
+                    self._complete(filepath, "stable", pending_only=True)
+                elif now - since >= STALE_PENDING:
+                    logging.warning(f"{filepath} hasn't changed for {STALE_PENDING:.0f} s "
+                                    f"and its header is still incomplete")
+                    self._complete(filepath, "stale", pending_only=True)
 
-def process_wav_file(filepath):
+class Player:
     """
-    Processes a .wav file using main.py and then removes it.
+    Plays files through the Chatter Pi engine, loaded once and kept running.
+    If the engine can't be loaded (or PyAudio can't be opened) it falls back
+    to one main.py subprocess per file. Once it is running, an error playing
+    a file (PyAudio raises OSError for e.g. an unsupported sample rate) only
+    fails that file's job.
     """
-    try:
-        # Run main.py with the filepath as an argument
-        result = subprocess.run([sys.executable, "../src/main.py", os.path.abspath(filepath)],
-                                cwd="../src", capture_output=True, text=True, check=True)
+    def __init__(self, isolated=False):
+        self.isolated = isolated
+        self.control = None
+
+    def warm_up(self):
+        """Loads the engine now, rather than when the first file arrives"""
+        if self.isolated or self.control is not None:
+            return
+        try:
+            import control
+            control.a.p     # PyAudio is opened on first use
+            self.control = control
+        except Exception as e:
+            logging.error(f"Could not load the audio engine ({e}); using subprocess mode")
+            self.isolated = True
+
+    def play(self, job):
+        """Plays a job's file; returns the mode it was played in"""
+        self.warm_up()
+        if not self.isolated:
+            if job.stream is not None:
+                self.play_stream(job.stream, job.detected)
+                return "streamed"
+            if job.asset is not None:
+                asset = job.asset
+                clip = self.control.audioserver.Clip(asset.pcm, asset.channels, 2, asset.rate)
+                self.control.a.play_vocal_track(clip, job.detected, asset.jaw_track)
+                return "in-process"
+            self.control.tracks.play_file(job.play_path, job.detected, job.jaw_track)
+            return "in-process"
+        if job.stream is not None:
+            job.stream.wait_written()   # main.py needs the finished file
+        result = subprocess.run([sys.executable, os.path.join(SRC_DIR, "main.py"), job.play_path],
+                                cwd=SRC_DIR, capture_output=True, text=True, check=True)
         print(result.stdout)
+        return "subprocess"
+
+    def play_stream(self, reader, detected):
+        """Plays a file that is still being written, starting once enough is buffered"""
+        reader.wait_ready()
+        try:
+            self.control.a.play_vocal_track(reader, detected)
+        finally:
+            reader.close()
+        if reader.underruns:
+            logging.warning(f"{reader.underruns} buffer underruns while streaming {reader.filename}")
+
+    def first_audio_latency(self):
+        """Detection-to-first-audio time of the last in-process file, or None
+        if no audio of it was played"""
+        if self.control is None:
+            return None
+        return self.control.a.last_latency
+
+def normalize(job, tempdir):
+    """
+    Checks that a job's file is a readable PCM WAV. 8, 24 and 32-bit files are
+    converted to 16-bit in tempdir, since the jaw analysis expects 16-bit samples.
+    """
+    with wave.open(job.path, 'rb') as wf:
+        params = wf.getparams()
+        if params.nchannels not in (1, 2):
+            raise ValueError(f"{params.nchannels} channels (only mono or stereo is supported)")
+        if params.sampwidth == 2:
+            return
+        if params.sampwidth not in (1, 3, 4):
+            raise ValueError(f"unsupported sample width {params.sampwidth}")
+        frames = wf.readframes(params.nframes)
+
+    import numpy as np
+    if params.sampwidth == 1:       # unsigned 8-bit
+        samples = (np.frombuffer(frames, np.uint8).astype(np.int16) - 128) << 8
+    elif params.sampwidth == 3:     # keep the top two bytes of each 24-bit sample
+        samples = np.frombuffer(frames, np.uint8).reshape(-1, 3)[:, 1:].copy().view('<i2').ravel()
+    else:
+        samples = (np.frombuffer(frames, '<i4') >> 16).astype('<i2')
+
+    job.play_path = os.path.join(tempdir, os.path.basename(job.path))
+    with wave.open(job.play_path, 'wb') as out:
+        out.setnchannels(params.nchannels)
+        out.setsampwidth(2)
+        out.setframerate(params.framerate)
+        out.writeframes(samples.astype('<i2').tobytes())
+
+class Pipeline:
+    """
+    Detection -> validation/normalization -> jaw precomputation (process pool)
+    -> playback. Arrivals wait in a priority queue; the ready queue holds at
+    most `lookahead` prepared files. A file that fails to play is retried up to
+    `retries` times with exponential backoff; a file that fails validation, or
+    keeps failing, is moved to `dead_letter` (default: failed/ next to it).
+    """
+    def __init__(self, player, lookahead=3, workers=None, streaming=False, cache_mb=64,
+                 order='priority', retries=3, dead_letter=None, backoff=1.0, metrics=None):
+        self.player = player
+        self.metrics = metrics or Metrics()
+        self.metrics.gauges = self.gauges
+        self.order = order
+        self.retries = retries
+        self.dead_letter = dead_letter
+        self.backoff = backoff
+        self.queued = set()     # paths somewhere in the pipeline, so none is queued twice
+        self.lock = threading.Lock()
+        self._seq = itertools.count()
+        self.cache = AssetCache(int(cache_mb * 2**20)) if cache_mb > 0 else None
+        self.streaming = streaming and not player.isolated
+        self.streams = {}       # path -> GrowingWavReader of files still being written
+        self.arrivals = queue.PriorityQueue()
+        self.ready = queue.Queue(maxsize=lookahead)
+        self.tempdir = tempfile.mkdtemp(prefix='chatterpi-')
+        self.pool = None
+        if not player.isolated:
+            import config as c
+            import jawtrack
+            import wavstream
+            self.config = c
+            self.jawtrack = jawtrack
+            self.wavstream = wavstream
+            self.pool = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, filepath, priority=0, mtime=None):
+        """Queues a complete file, or tells its stream that writing has finished"""
+        with self.lock:
+            reader = self.streams.pop(filepath, None)
+        if reader is not None:
+            reader.mark_complete()
+            return
+        with self.lock:
+            if filepath in self.queued:
+                return
+            self.queued.add(filepath)
+        self._enqueue(WavJob(filepath, priority, mtime))
+
+    def submit_stream(self, filepath, priority=0):
+        """Queues a file that is still being written"""
+        with self.lock:
+            if filepath in self.queued:
+                return
+            self.queued.add(filepath)
+        self.config.update()
+        cfg = self.config.current
+        job = WavJob(filepath, priority)
+        job.stream = self.wavstream.GrowingWavReader(filepath, cfg.STREAM_START_SECONDS,
+                                                     cfg.STREAM_UNDERRUN, cfg.STREAM_IDLE_TIMEOUT)
+        self.streams[filepath] = job.stream
+        self._enqueue(job)
+
+    def gauges(self):
+        """Queue depths and cache figures for the metrics export"""
+        gauges = {'queue_arriving': self.arrivals.qsize(), 'queue_prepared': self.ready.qsize()}
+        if self.cache is not None:
+            gauges.update(cache_hits=self.cache.hits, cache_misses=self.cache.misses,
+                          cache_bytes=self.cache.bytes)
+        return gauges
+
+    def _enqueue(self, job):
+        key = (job.mtime,) if self.order == 'mtime' else (-job.priority, job.mtime)
+        self.arrivals.put((key, next(self._seq), job))
+
+    def _finish(self, job):
+        with self.lock:
+            self.queued.discard(job.path)
 
-        logging.info(f"Successfully processed {filepath}")
-        
-        # Remove the file after processing
-        os.remove(filepath)
-        logging.info(f"Removed processed file: {filepath}")
+    def fail(self, job, reason, retry=True):
+        """Schedules another attempt at a failed job, or dead-letters it"""
+        self.metrics.record(job, reason)
+        if not os.path.exists(job.path):
+            logging.error(f"Giving up on {job.path}: the file is gone")
+            self._finish(job)
+        elif retry and job.attempts < self.retries:
+            delay = self.backoff * 2 ** job.attempts
+            logging.warning(f"Retrying {job.path} in {delay:.1f} s "
+                            f"(attempt {job.attempts + 2} of {self.retries + 1})")
+            self.metrics.count('retries')
+            timer = threading.Timer(delay, self._retry, (job,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.metrics.count('dead_letter')
+            self._dead_letter(job, reason)
+            self._finish(job)
+
+    def _retry(self, job):
+        again = WavJob(job.path, job.priority, job.mtime)
+        again.attempts = job.attempts + 1
+        self._enqueue(again)
+
+    def _dead_letter(self, job, reason):
+        """Moves a file that can't be played out of the way, with a note saying why"""
+        directory = self.dead_letter or os.path.join(os.path.dirname(job.path), 'failed')
+        try:
+            os.makedirs(directory, exist_ok=True)
+            dest = os.path.join(directory, os.path.basename(job.path))
+            shutil.move(job.path, dest)
+            with open(dest + '.error', 'w') as f:
+                f.write(f"{reason}\n")
+            logging.error(f"Moved {job.path} to {directory}: {reason}")
+        except OSError as e:
+            logging.error(f"Could not move {job.path} to {directory}: {e}")
+
+    def scan(self, directory, priority=0, unfinished=None):
+        """Queues the .wav files already in a directory. Entries are queued as
+        they are read, so a large backlog doesn't hold up startup. Files that
+        are still being written go to unfinished(path) to wait for them."""
+        count = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if (entry.name.endswith('.wav') and not entry.name.startswith('.')
+                            and entry.is_file()):
+                        if not wav_data_complete(entry.path):
+                            if unfinished is not None:
+                                unfinished(entry.path)
+                            continue
+                        self.submit(entry.path, priority, entry.stat().st_mtime)
+                        count += 1
+        except OSError as e:
+            logging.error(f"Could not scan {directory}: {e}")
+        logging.info(f"Found {count} existing WAV files in {directory}")
+
+    def start(self):
+        threading.Thread(target=self._prepare, daemon=True).start()
+        threading.Thread(target=self._play, daemon=True).start()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def _prepare(self):
+        from trackindex import file_hash
+        while True:
+            job = self.arrivals.get()[-1]
+            if job.stream is not None:
+                if not self._streamable(job):
+                    continue
+                # analyzed chunk by chunk while it plays
+                job.validated = job.prepared = time.monotonic()
+                self.ready.put(job)
+                continue
+            if self.cache is not None and not self.player.isolated:
+                try:
+                    job.digest = file_hash(job.path)
+                except OSError as e:
+                    self.fail(job, f"could not read it: {e}")
+                    continue
+                job.asset = self.cache.get(job.digest)
+                if job.asset is not None:
+                    job.cache_hit = True
+                    logging.info(f"Cache hit for {job.path} ({job.asset.duration:.1f} s)")
+                    job.validated = job.prepared = time.monotonic()
+                    self.ready.put(job)
+                    continue
+            try:
+                normalize(job, self.tempdir)
+            except OSError as e:
+                self.fail(job, f"could not read it: {e}")
+                continue
+            except (wave.Error, EOFError, ValueError) as e:
+                self.fail(job, f"not a playable WAV file: {str(e) or type(e).__name__}", retry=False)
+                continue
+            if job.digest is not None:
+                # played from memory, and kept for the next copy of this file
+                with wave.open(job.play_path, 'rb') as wf:
+                    job.asset = PreparedAsset(wf.readframes(wf.getnframes()),
+                                              wf.getnchannels(), wf.getframerate(), None)
+            job.validated = time.monotonic()
+            if self.pool is not None and not self.player.isolated:
+                self.config.update()
+                cfg = self.config.current
+                job.jaw_future = self.pool.submit(self.jawtrack.compute_jaw_track,
+                                                  job.play_path, cfg.BUFFER_SIZE, cfg.STYLE)
+                job.jaw_future.add_done_callback(
+                    lambda future, job=job: setattr(job, 'prepared', time.monotonic()))
+            else:
+                job.prepared = job.validated
+            self.ready.put(job)     # waits while `lookahead` files are already prepared
+
+    def _streamable(self, job):
+        """Checks the format of a file that is still being written. One whose
+        header hasn't arrived yet is queued again shortly rather than waited
+        for, so other files aren't held up. One that can't be streamed (not
+        16-bit mono or stereo PCM, or no header within STREAM_HEADER_TIMEOUT)
+        is played like any other file once it is complete, and converted
+        first if need be: it is queued again now if writing has already
+        finished, else by submit()."""
+        reader = job.stream
+        if reader.wait_header(0):
+            if reader.getsampwidth() == 2 and reader.getnchannels() in (1, 2):
+                return True
+        elif reader.error is None and time.monotonic() - job.detected < STREAM_HEADER_TIMEOUT:
+            timer = threading.Timer(HEADER_RECHECK, self._enqueue, (job,))
+            timer.daemon = True
+            timer.start()
+            return False
+        reader.close()
+        logging.info(f"Can't stream {job.path}; it will play once it is complete")
+        with self.lock:
+            still_writing = self.streams.pop(job.path, None) is not None
+            self.queued.discard(job.path)
+        if not still_writing:
+            self.submit(job.path, job.priority)
+        return False
+
+    def _play(self):
+        while True:
+            job = self.ready.get()
+            if job.jaw_future is not None:
+                try:
+                    job.jaw_track = job.jaw_future.result()
+                except Exception as e:
+                    logging.error(f"Jaw precomputation failed for {job.path} ({e}); analyzing live")
+                if job.prepared is None:    # done callback may not have run yet
+                    job.prepared = time.monotonic()
+                if job.asset is not None:
+                    job.asset.jaw_track = job.jaw_track
+                    self.cache.put(job.digest, job.asset)
+            error = process_wav_file(self.player, job)
+            self.streams.pop(job.path, None)
+            if error is None:
+                self.metrics.record(job)
+                self._finish(job)
+            else:
+                self.fail(job, error)
+            logging.info(f"Queue depth: {self.arrivals.qsize()} arriving, {self.ready.qsize()} prepared")
+            if self.cache is not None:
+                logging.info(f"Asset cache: {self.cache.report()}")
+            logging.info(f"Metrics: {self.metrics.summary()}")
+
+def process_wav_file(player, job):
+    """
+    Plays a job's file and then removes it, logging how long each stage took.
+    Returns None on success, or what went wrong.
+    """
+    try:
+        job.started = time.monotonic()
+        job.mode = mode = player.play(job)
+        job.finished = time.monotonic()
+        first_audio = player.first_audio_latency() if mode != "subprocess" else None
+        job.first_audio = first_audio
+        timing = (f"validate {(job.validated - job.detected) * 1000:.0f} ms, "
+                  f"prepare {(job.prepared - job.validated) * 1000:.0f} ms, "
+                  f"wait {(job.started - job.prepared) * 1000:.0f} ms, ")
+        if first_audio is not None:
+            timing += f"first audio {first_audio * 1000:.0f} ms, "
+        timing += f"total {(job.finished - job.detected) * 1000:.0f} ms"
+        logging.info(f"Successfully processed {job.path} ({mode}: {timing})")
     except subprocess.CalledProcessError as e:
-        logging.error(f"Error processing {filepath}:\n{e.stderr}")
+        logging.error(f"Error processing {job.path}:\n{e.stderr}")
+        return f"main.py exited with status {e.returncode}"
     except Exception as e:
-        logging.error(f"Unexpected error processing {filepath}:\n{str(e)}")
+        logging.error(f"Unexpected error processing {job.path}:\n{str(e)}")
+        return str(e)
 
-def watch_directory(directory):
+    # Remove the file (and any converted copy) after processing
+    try:
+        os.remove(job.path)
+        if job.play_path != job.path:
+            os.remove(job.play_path)
+        logging.info(f"Removed processed file: {job.path}")
+    except OSError as e:
+        logging.error(f"Could not remove {job.path}: {e}")
+    return None
+
+def watch_directory(directories, isolated=False, lookahead=3, workers=None, streaming=False,
+                    cache_mb=64, order='priority', retries=3, dead_letter=None,
+                    metrics_file=None, metrics_port=None, events_log=None):
     """
-    Watches the specified directory for new .wav files.
+    Watches the specified directories for new .wav files. directories is a
+    list of (path, priority) pairs; higher priorities play first.
     """
-    event_handler = WavFileHandler()
+    directories = [(os.path.abspath(path), priority) for path, priority in directories]
+    if dead_letter is not None:
+        dead_letter = os.path.abspath(dead_letter)
+    if metrics_file is not None:
+        metrics_file = os.path.abspath(metrics_file)
+    if events_log is not None:
+        events_log = os.path.abspath(events_log)
+    # config.ini and the track folders are relative to src
+    os.chdir(SRC_DIR)
+    sys.path.insert(0, SRC_DIR)
+
+    player = Player(isolated)
+    player.warm_up()
+    if streaming and player.isolated:
+        logging.warning("Streaming needs in-process playback; waiting for complete files instead")
+    metrics = Metrics(events_log)
+    pipeline = Pipeline(player, lookahead, workers, streaming, cache_mb,
+                        order, retries, dead_letter, metrics=metrics)
+    pipeline.start()
+    if metrics_port:
+        metrics.serve(metrics_port)
+
     observer = Observer()
-    observer.schedule(event_handler, directory, recursive=False)
+    close_events = supports_close_events(observer)
+    handlers = []
+    for directory, priority in directories:
+        event_handler = WavFileHandler(pipeline, directory, priority, close_events)
+        observer.schedule(event_handler, directory, recursive=False)
+        handlers.append(event_handler)
+        logging.info(f"Watching directory: {directory} (priority {priority})")
     observer.start()
-    logging.info(f"Watching directory: {directory}")
-    
-    # Process any existing .wav files in the directory
-    for filename in os.listdir(directory):
-        if filename.endswith('.wav'):
-            filepath = os.path.join(directory, filename)
-            logging.info(f"Found existing WAV file: {filepath}")
-            process_wav_file(filepath)
-    
+
+    # Queue the files that were already there, without holding up the watch
+    for handler in handlers:
+        threading.Thread(target=pipeline.scan, args=(handler.directory, handler.priority,
+                                                     handler.track), daemon=True).start()
+
+    last_export = 0.0
     try:
         while True:
             time.sleep(1)
+            if metrics_file is not None and time.monotonic() - last_export >= 10:
+                metrics.write_file(metrics_file)
+                last_export = time.monotonic()
     except KeyboardInterrupt:
         observer.stop()
         logging.info("Stopping directory watch")
     finally:
         observer.join()
+        pipeline.close()
 
 def main():
-    # Check if a directory argument was provided
-    if len(sys.argv) < 2:
-        print("Usage: daemon.py <directory_to_watch>")
-        sys.exit(1)
-    
-    watch_dir = sys.argv[1]
-    
-    if not os.path.isdir(watch_dir):
-        print(f"Error: {watch_dir} is not a valid directory")
-        sys.exit(1)
-    
-    # Start watching the directory
-    watch_directory(watch_dir)
+    parser = argparse.ArgumentParser(description='Play .wav files dropped into a directory')
+    parser.add_argument('directories', nargs='+', metavar='DIR[=PRIORITY]',
+                        help='Directories to watch, optionally with a priority (default 0; '
+                             'higher plays first)')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='Run main.py in a separate process for every file')
+    parser.add_argument('--lookahead', type=int, default=3,
+                        help='How many files to prepare ahead of the one playing (default 3)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes used for jaw precomputation (default: one per CPU)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Start playing files while they are still being written')
+    parser.add_argument('--cache-mb', type=float, default=64,
+                        help='Memory for prepared copies of recent files, 0 to disable (default 64)')
+    parser.add_argument('--order', choices=('priority', 'mtime'), default='priority',
+                        help='Play waiting files by directory priority then age, '
+                             'or by age alone (default priority)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Attempts after the first before a file is given up on (default 3)')
+    parser.add_argument('--dead-letter', default=None,
+                        help='Where failed files go (default: failed/ in their directory)')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write Prometheus text metrics to this file every 10 s')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this localhost port')
+    parser.add_argument('--events-log', default=None,
+                        help='Append a JSON line per processed file to this file')
+    args = parser.parse_args()
+
+    directories = []
+    for arg in args.directories:
+        path, sep, priority = arg.rpartition('=')
+        if not sep or not priority.lstrip('-').isdigit():
+            path, priority = arg, 0
+        if not os.path.isdir(path):
+            print(f"Error: {path} is not a valid directory")
+            sys.exit(1)
+        directories.append((path, int(priority)))
+
+    # Start watching the directories
+    watch_directory(directories, args.subprocess, args.lookahead, args.workers, args.stream,
+                    args.cache_mb, args.order, args.retries, args.dead_letter,
+                    args.metrics_file, args.metrics_port, args.events_log)
 
 if __name__ == "__main__":
     main()